@@ -30,6 +30,65 @@ class InitDB(CkanCommand):
         log.info("DB tables are setup")
 
 
+class UpgradeDB(CkanCommand):
+    """Upgrades the extension's existing database tables in place
+
+    Usage: paster upgradedb [--batch-size=N] [--partition]
+
+    Converts the page view, visit and stat value columns, which older
+    versions stored as text, to numeric columns. Rows are converted in
+    batches of --batch-size (default 10000), each in its own transaction.
+    Then moves the url data to the ga_url_dim layout, where each url is
+    stored once and referred to by id, rebuilds the ga_resource_map table
+    of resource urls from the resource history, and adds any missing
+    indexes, using CREATE INDEX CONCURRENTLY so that the tables stay
+    writable. It is safe to run this more than once.
+
+    With --partition the per-period tables are also converted to tables
+    partitioned by period (needs PostgreSQL 11+), so that the queries for a
+    month, and the deletes that replace its rows when it is reloaded (e.g.
+    with --delete-first), only touch its partition. Writes to each table
+    wait while it is copied.
+    """
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 0
+    min_args = 0
+
+    def __init__(self, name):
+        super(UpgradeDB, self).__init__(name)
+        self.parser.add_option('-b', '--batch-size',
+                               type='int',
+                               default=10000,
+                               dest='batch_size',
+                               help='Number of rows to convert per transaction')
+        self.parser.add_option('-p', '--partition',
+                               action='store_true',
+                               default=False,
+                               dest='partition',
+                               help='Partition the per-period tables by period')
+
+    def command(self):
+        self._load_config()
+
+        import ckan.model as model
+        model.Session.remove()
+        model.Session.configure(bind=model.meta.engine)
+        log = logging.getLogger('ckanext.ga_report')
+
+        import ga_model
+        # The url layout has to be migrated before create_all, which would
+        # create ga_url_all in the new layout
+        ga_model.migrate_numeric_columns(batch_size=self.options.batch_size)
+        ga_model.migrate_url_layout()
+        ga_model.metadata.create_all(model.meta.engine)
+        ga_model.seed_resource_map()
+        ga_model.create_indexes(concurrently=True)
+        if self.options.partition:
+            ga_model.partition_tables()
+        log.info("DB tables are upgraded")
+
+
 class GetAuthToken(CkanCommand):
     """ Get's the Google auth token
 
@@ -56,11 +115,12 @@ class GetAuthToken(CkanCommand):
 
 class FixTimePeriods(CkanCommand):
     """
-    Fixes the 'All' records for GA_Urls
+    Rebuilds the all-time totals for GA_Urls
 
-    It is possible that older urls that haven't recently been visited
-    do not have All records.  This command will traverse through those
-    records and generate valid All records for them.
+    The totals in ga_url_all are kept up to date as each period is loaded.
+    This command recalculates them from every period in ga_url, which is
+    needed once after upgrading from the old 'All' period rows, or to
+    repair them.
     """
     summary = __doc__.split('\n')[0]
     usage = __doc__
@@ -79,7 +139,7 @@ class FixTimePeriods(CkanCommand):
 
         log = logging.getLogger('ckanext.ga_report')
 
-        log.info("Updating 'All' records for old URLs")
+        log.info("Rebuilding the all-time totals for URLs")
         post_update_url_stats()
         log.info("Processing complete")
 
@@ -89,12 +149,28 @@ class LoadAnalytics(CkanCommand):
     """Get data from Google Analytics API and save it
     in the ga_model
 
-    Usage: paster loadanalytics <time-period>
+    Usage: paster loadanalytics [--replay] [--processes=N] <time-period>
 
     Where <time-period> is:
-        all         - data for all time
-        latest      - (default) just the 'latest' data
-        YYYY-MM     - just data for the specific month
+        all             - data for all time
+        latest          - (default) just the 'latest' data
+        YYYY-MM         - just data for the specific month
+        YYYY-MM:YYYY-MM - data for each month in the range
+
+    'all' and month ranges are backfilled: up to --processes months are
+    loaded at once, each in its own worker process, and months that a
+    previous backfill completed are skipped (unless --delete-first or
+    --replay is given, which load them all again).
+
+    With --incremental, 'latest' only loads the days since the last load
+    (up to yesterday) and adds them onto the month's figures. A last load
+    from before the previous month isn't caught up on: the current month
+    is loaded from its start instead.
+
+    If ga-report.cache_dir is configured, every response from Google
+    Analytics is stored there. With --replay the responses are read back
+    from it instead, without any network access, e.g. to rebuild the
+    tables after fixing the resource or publisher data.
     """
     summary = __doc__.split('\n')[0]
     usage = __doc__
@@ -113,14 +189,42 @@ class LoadAnalytics(CkanCommand):
                                default=False,
                                dest='skip_url_stats',
                                help='Skip the download of URL data - just do site-wide stats')
+        self.parser.add_option('-r', '--replay',
+                               action='store_true',
+                               default=False,
+                               dest='replay',
+                               help='Use the cached responses instead of Google Analytics')
+        self.parser.add_option('-i', '--incremental',
+                               action='store_true',
+                               default=False,
+                               dest='incremental',
+                               help="Only load the days since the last load (for 'latest')")
+        self.parser.add_option('-p', '--processes',
+                               type='int',
+                               default=1,
+                               dest='processes',
+                               help='Number of months to backfill at once')
         self.token = ""
 
     def command(self):
         self._load_config()
 
-        from download_analytics import DownloadAnalytics
+        from download_analytics import DownloadAnalytics, get_response_cache
         from ga_auth import (init_service, get_profile_id)
 
+        cache = get_response_cache()
+        if self.options.replay:
+            if cache is None or not cache.get_profile_id():
+                print 'ERROR: To replay, ga-report.cache_dir needs to point at the ' \
+                      'responses cached by a previous load'
+                return
+            downloader = DownloadAnalytics(profile_id=cache.get_profile_id(),
+                                           delete_first=self.options.delete_first,
+                                           skip_url_stats=self.options.skip_url_stats,
+                                           replay=True)
+            self._download(downloader)
+            return
+
         ga_token_filepath = os.path.expanduser(config.get('googleanalytics.token.filepath', ''))
         if not ga_token_filepath:
             print 'ERROR: In the CKAN config you need to specify the filepath of the ' \
@@ -135,16 +239,127 @@ class LoadAnalytics(CkanCommand):
                    '"googleanalytics.token.filepath"?')
             return
 
-        downloader = DownloadAnalytics(svc, self.token, profile_id=get_profile_id(svc),
+        profile_id = get_profile_id(svc)
+        if cache is not None:
+            cache.set_profile_id(profile_id)
+        downloader = DownloadAnalytics(svc, self.token, profile_id=profile_id,
                                        delete_first=self.options.delete_first,
                                        skip_url_stats=self.options.skip_url_stats)
+        self._download(downloader)
 
+    def _download(self, downloader):
         time_period = self.args[0] if self.args else 'latest'
         if time_period == 'all':
-            downloader.all_()
+            downloader.all_(processes=self.options.processes)
+        elif time_period == 'latest' and self.options.incremental:
+            downloader.latest_incremental()
         elif time_period == 'latest':
             downloader.latest()
+        elif ':' in time_period:
+            first_month, last_month = [datetime.datetime.strptime(month, '%Y-%m')
+                                       for month in time_period.split(':')]
+            downloader.backfill(first_month, last_month,
+                                processes=self.options.processes)
         else:
             # The month to use
             for_date = datetime.datetime.strptime(time_period, '%Y-%m')
             downloader.specific_month(for_date)
+
+
+class BenchmarkLoad(CkanCommand):
+    """Times a load of synthetic analytics from a local fake Google Analytics
+
+    Usage: paster benchmarkload [options]
+
+    Serves made up analytics for the given number of datasets,
+    organizations and downloaded resources from a local stand-in for the
+    Google Analytics API (see fake_ga.py), loads --months months of them
+    with the same code as loadanalytics and prints how long each phase of
+    the load took. The names of this site's datasets, organizations and
+    resources are used where there are enough of them, so that the urls
+    resolve as they would for real. No Google account is needed.
+
+    The ga-report.fetch_concurrency and ga-report.batch_requests options
+    apply, as they would to a real load.
+
+    WARNING: the synthetic analytics are stored in this site's ga tables,
+    replacing the months that are loaded, so only run it against a test
+    database.
+    """
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 0
+    min_args = 0
+
+    def __init__(self, name):
+        super(BenchmarkLoad, self).__init__(name)
+        self.parser.add_option('--datasets', type='int', default=1000,
+                               dest='datasets',
+                               help='Number of datasets with page views')
+        self.parser.add_option('--organizations', type='int', default=50,
+                               dest='organizations',
+                               help='Number of organizations with page views')
+        self.parser.add_option('--downloads', type='int', default=5000,
+                               dest='downloads',
+                               help='Number of resources that are downloaded')
+        self.parser.add_option('--months', type='int', default=3,
+                               dest='months',
+                               help='Number of months to load, up to last month')
+        self.parser.add_option('--seed', type='int', default=0,
+                               dest='seed',
+                               help='Seed for the synthetic analytics')
+
+    def command(self):
+        self._load_config()
+
+        import time
+        import ckan.model as model
+        import ga_model
+        from download_analytics import DownloadAnalytics
+        from fake_ga import FakeGA, FakeGAServer, StaticToken, PROFILE_ID
+        from ga_client import GA
+
+        ga_model.metadata.create_all(model.meta.engine)
+
+        datasets = [name for (name,) in model.Session.query(model.Package.name)
+                    .filter_by(state='active').limit(self.options.datasets)]
+        organizations = [name for (name,) in model.Session.query(model.Group.name)
+                         .filter_by(state='active', is_organization=True)
+                         .limit(self.options.organizations)]
+        resources = [id for (id,) in model.Session.query(model.Resource.id)
+                     .filter_by(state='active').limit(self.options.downloads)]
+        fake = FakeGA(self.options.datasets, self.options.organizations,
+                      self.options.downloads, seed=self.options.seed,
+                      dataset_names=datasets, organization_names=organizations,
+                      resource_ids=resources)
+
+        server = FakeGAServer(fake).start()
+        try:
+            downloader = DownloadAnalytics(profile_id=PROFILE_ID)
+            downloader.client = GA(StaticToken(), api_url=server.api_url,
+                                   batch_url=server.batch_url, retries=0)
+            now = datetime.datetime.now()
+            last_month = datetime.datetime(now.year, now.month, 1) - \
+                datetime.timedelta(1)
+            first_month = last_month
+            for i in range(self.options.months - 1):
+                first_month = datetime.datetime(first_month.year,
+                                                first_month.month, 1) - \
+                    datetime.timedelta(1)
+            periods = downloader.month_periods(first_month, last_month)
+
+            started = time.time()
+            downloader.download_and_store(periods)
+            total = time.time() - started
+        finally:
+            server.stop()
+
+        print '%d months, %d datasets (%d from this site), %d organizations ' \
+              '(%d), %d downloads (%d)' % (
+                  len(periods), self.options.datasets, len(datasets),
+                  self.options.organizations, len(organizations),
+                  self.options.downloads, len(resources))
+        print '%d requests to the fake Google Analytics' % len(server.requests)
+        for phase, seconds in downloader.timings.items():
+            print '%-20s %8.2fs' % (phase, seconds)
+        print '%-20s %8.2fs' % ('total', total)
@@ -10,7 +10,7 @@ from ckan.lib.base import (BaseController, c, g, render, request, response, abor
 import sqlalchemy
 from sqlalchemy import func, cast, Integer
 import ckan.model as model
-from ga_model import GA_Url, GA_Stat, GA_ReferralStat, GA_Publisher
+from ga_model import GA_Url, GA_UrlTotal, GA_Stat, GA_ReferralStat, GA_Publisher
 
 log = logging.getLogger('ckanext.ga-report')
 
@@ -77,7 +77,7 @@ class GaReport(BaseController):
             writer.writerow([entry.period_name.encode('utf-8'),
                              entry.stat_name.encode('utf-8'),
                              entry.key.encode('utf-8'),
-                             entry.value.encode('utf-8')])
+                             entry.value])
 
 
     def index(self):
@@ -195,7 +195,7 @@ class GaReport(BaseController):
             if c.month:
                 entries = []
                 q = q.filter(GA_Stat.period_name==c.month).\
-                          order_by('ga_stat.value::int desc')
+                          order_by(GA_Stat.value.desc())
             d = collections.defaultdict(int)
             for e in q.all():
                 d[e.key] += int(e.value)
@@ -322,13 +322,16 @@ class GaDatasetReport(BaseController):
         if month != 'All':
             have_download_data = month >= DOWNLOADS_AVAILABLE_FROM
 
-        q = model.Session.query(GA_Url,model.Package)\
-            .filter(model.Package.name==GA_Url.package_id)\
-            .filter(GA_Url.url.like('/data/dataset/%'))
+        # The all-time figures come from the rollup of every period
+        cls = GA_UrlTotal if month == 'All' else GA_Url
+        q = model.Session.query(cls,model.Package)\
+            .filter(model.Package.name==cls.package_id)\
+            .filter(cls.url.like('/data/dataset/%'))
         if publisher:
-            q = q.filter(GA_Url.department_id==publisher.name)
-        q = q.filter(GA_Url.period_name==month)
-        q = q.order_by('ga_url.pageviews::int desc')
+            q = q.filter(cls.department_id==publisher.name)
+        if month != 'All':
+            q = q.filter(GA_Url.period_name==month)
+        q = q.order_by(cls.pageviews.desc())
         top_packages = []
         if count == -1:
             entries = q.all()
@@ -391,9 +394,13 @@ class GaDatasetReport(BaseController):
 
         month = c.month or 'All'
         c.publisher_page_views = 0
-        q = model.Session.query(GA_Url).\
-            filter(GA_Url.url=='/publisher/%s' % c.publisher_name)
-        entry = q.filter(GA_Url.period_name==c.month).first()
+        if c.month:
+            entry = model.Session.query(GA_Url).\
+                filter(GA_Url.url=='/publisher/%s' % c.publisher_name).\
+                filter(GA_Url.period_name==c.month).first()
+        else:
+            entry = model.Session.query(GA_UrlTotal).\
+                filter(GA_UrlTotal.url=='/publisher/%s' % c.publisher_name).first()
         c.publisher_page_views = entry.pageviews if entry else 0
 
         c.top_packages = self._get_packages(publisher=c.publisher, count=20, month=c.month)
@@ -413,7 +420,7 @@ class GaDatasetReport(BaseController):
                 'name':package.title,
                 'raw': {}
                 })
-            all_series[package.name]['raw'][entry.period_name] = int(entry.pageviews)
+            all_series[package.name]['raw'][entry.period_name] = entry.pageviews
         graph = [ all_series[series_name] for series_name in top_package_names ]
         c.graph_data = json.dumps( _to_rickshaw(graph) )
 
@@ -471,14 +478,22 @@ def _get_top_publishers(limit=20):
     '''
     month = c.month or 'All'
     connection = model.Session.connection()
+    if month == 'All':
+        urls = """select d.department_id, d.package_id, d.url, t.pageviews, t.visits
+                    from ga_url_all t join ga_url_dim d on d.id = t.url_id"""
+        params = [month]
+    else:
+        urls = """select d.department_id, d.package_id, d.url, f.pageviews, f.visits
+                    from ga_url f join ga_url_dim d on d.id = f.url_id
+                    where f.period_name=%s"""
+        params = [month, month]
     q = """
-        select department_id, sum(pageviews::int) views, sum(visits::int) visits, max(s.value) downloads
-        from ga_url full outer join (select period_name,key,value::int from ga_stat where stat_name = 'Downloads by Organisation'
-        union select 'All',key,sum(value::int) from ga_stat where stat_name = 'Downloads by Organisation' group by key) s on s.key = department_id
+        select department_id, sum(pageviews) views, sum(visits) visits, max(s.value) downloads
+        from (""" + urls + """) u full outer join (select period_name,key,value from ga_stat where stat_name = 'Downloads by Organisation'
+        union select 'All',key,sum(value) from ga_stat where stat_name = 'Downloads by Organisation' group by key) s on s.key = department_id
         where department_id <> ''
           and package_id <> ''
           and url like '/data/dataset/%%'
-          and ga_url.period_name=%s
           and s.period_name=%s
         group by department_id order by views desc
         """
@@ -486,7 +501,7 @@ def _get_top_publishers(limit=20):
         q = q + " limit %s;" % (limit)
 
     top_publishers = []
-    res = connection.execute(q, month, month)
+    res = connection.execute(q, *params)
     for row in res:
         g = model.Group.get(row[0])
         if g:
@@ -501,12 +516,11 @@ def _get_top_publishers_graph(limit=20):
     '''
     connection = model.Session.connection()
     q = """
-        select department_id, sum(pageviews::int) views
-        from ga_url
+        select department_id, sum(pageviews) views
+        from ga_url_all t join ga_url_dim d on d.id = t.url_id
         where department_id <> ''
           and package_id <> ''
           and url like '/data/dataset/%%'
-          and period_name='All'
         group by department_id order by views desc
         """
     if limit:
@@ -519,7 +533,7 @@ def _get_top_publishers_graph(limit=20):
     q = model.Session.query(
             GA_Url.department_id,
             GA_Url.period_name,
-            func.sum(cast(GA_Url.pageviews,sqlalchemy.types.INT)))\
+            func.sum(GA_Url.pageviews))\
         .filter( GA_Url.department_id.in_(department_ids) )\
         .filter( GA_Url.url.like('/data/dataset/%') )\
         .filter( GA_Url.package_id!='' )\
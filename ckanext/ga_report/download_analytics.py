@@ -4,14 +4,18 @@ import datetime
 import httplib
 import urllib
 import collections
-import requests
 import json
 import re
+import time
+import threading
+import contextlib
 from pylons import config
 from ga_model import _normalize_url
 import ga_model
 
-#from ga_client import GA
+from ga_client import (GA, GAError, ResponseCache, QuotaScheduler, QuotaExceeded,
+                       CacheMiss, MAX_BATCH_SIZE, API_URL, BATCH_URL)
+from paste.deploy.converters import asbool
 
 log = logging.getLogger('ckanext.ga-report')
 
@@ -19,18 +23,128 @@ FORMAT_MONTH = '%Y-%m'
 MIN_VIEWS = 0
 MIN_VISITS = 0
 MIN_DOWNLOADS = 0
+# The most rows that GA returns per request
+PAGE_SIZE = 10000
+
+class StatSpec(object):
+    '''
+    A breakdown of page views that is stored as a site-wide stat: the stat
+    name, a function giving the key that a row of GA results counts
+    towards (or None to leave the row out) and the smallest total that is
+    kept (see _filter_out_long_tail).
+    '''
+
+    def __init__(self, stat_name, key, threshold=MIN_VIEWS):
+        self.stat_name = stat_name
+        self.key = key
+        self.threshold = threshold
+
+# The breakdowns of page views by family, with the GA dimensions that the
+# family's query asks for. Every breakdown in a family is worked out from
+# the same query, in a single pass over its rows, so adding one costs no
+# extra requests.
+BREAKDOWNS = {
+    'social': ('ga:socialNetwork,ga:referralPath', [
+        StatSpec('Social sources',
+                 lambda row: row[0] if row[0] != '(not set)' else None,
+                 threshold=3),
+    ]),
+    'os': ('ga:operatingSystem,ga:operatingSystemVersion', [
+        StatSpec('Operating Systems', lambda row: row[0]),
+        StatSpec('Operating Systems versions', lambda row: '%s %s' % (row[0], row[1])),
+    ]),
+    'locale': ('ga:language,ga:country', [
+        StatSpec('Languages', lambda row: row[0]),
+        StatSpec('Country', lambda row: row[1]),
+    ]),
+    'browser': ('ga:browser,ga:browserVersion', [
+        # e.g. [u'Firefox', u'19.0', u'20']
+        StatSpec('Browsers', lambda row: row[0]),
+        StatSpec('Browser versions',
+                 lambda row: '%s %s' % (row[0],
+                     DownloadAnalytics._filter_browser_version(row[0], row[1]))),
+    ]),
+    'mobile': ('ga:mobileDeviceBranding, ga:mobileDeviceInfo', [
+        StatSpec('Mobile brands', lambda row: row[0]),
+        StatSpec('Mobile devices', lambda row: row[1]),
+    ]),
+}
+
+
+def aggregate_breakdowns(specs, rows):
+    '''Adds up the page views (the last column of each row) for every
+    breakdown in one pass over the rows. Returns {stat_name: {key: views}}
+    without the long tail.'''
+    stats = dict((spec.stat_name, {}) for spec in specs)
+    for row in rows:
+        views = int(row[-1])
+        for spec in specs:
+            key = spec.key(row)
+            if key is not None:
+                data = stats[spec.stat_name]
+                data[key] = data.get(key, 0) + views
+    for spec in specs:
+        DownloadAnalytics._filter_out_long_tail(stats[spec.stat_name], spec.threshold)
+    return stats
+
+
+def get_response_cache():
+    """The cache of GA responses configured by ga-report.cache_dir, or None."""
+    cache_dir = config.get('ga-report.cache_dir')
+    if not cache_dir:
+        return None
+    return ResponseCache(os.path.expanduser(cache_dir))
+
+def get_quota_scheduler(share=1):
+    '''The QuotaScheduler for the GA quotas in the config, or None if
+    ga-report.quota_per_second is 0. When `share` processes are loading at
+    once, each gets that share of the quotas.'''
+    per_second = float(config.get('ga-report.quota_per_second', 10))
+    per_day = int(config.get('ga-report.quota_per_day', 0))
+    if per_second <= 0:
+        return None
+    return QuotaScheduler(per_second / share, per_day // share or None)
+
+def _backfill_month(job):
+    '''Loads one month of a backfill. Runs in a worker process, with its
+    own database session and GA client. Returns (period_name, success).'''
+    import ckan.model as model
+    options, period = job
+    period_name, period_complete_day, start_date, end_date = period
+    downloader = DownloadAnalytics(**options)
+    try:
+        downloader.download_and_store([period], popularity=False)
+        now = datetime.datetime.now()
+        if (start_date.year, start_date.month) != (now.year, now.month):
+            ga_model.checkpoint_period(period_name)
+    except Exception, e:
+        log.exception(e)
+        model.Session.rollback()
+        return period_name, False
+    finally:
+        model.Session.remove()
+    return period_name, True
 
 class DownloadAnalytics(object):
     '''Downloads and stores analytics info'''
 
     def __init__(self, service=None, token=None, profile_id=None, delete_first=False,
-                 skip_url_stats=False):
+                 skip_url_stats=False, replay=False, quota_share=1):
         self.period = config['ga-report.period']
         self.service = service
         self.profile_id = profile_id
         self.delete_first = delete_first
         self.skip_url_stats = skip_url_stats
         self.token = token
+        self.replay = replay
+        # The number of processes sharing the GA quotas
+        self.quota_share = quota_share
+        self.client = None
+        self.resource_index = None
+        self.failed_fetches = []
+        self._client_lock = threading.Lock()
+        # Seconds spent in each phase of download_and_store
+        self.timings = collections.OrderedDict()
 
     def specific_month(self, date):
         import calendar
@@ -61,40 +175,159 @@ class DownloadAnalytics(object):
             raise NotImplementedError
         self.download_and_store(periods)
 
+    def latest_incremental(self):
+        '''
+        Loads just the days since the last load, up to and including
+        yesterday, and adds them onto the period's figures. Months that
+        haven't been loaded at all are loaded in full, also up to
+        yesterday, so a day is only ever loaded once it is over. A month
+        whose last load ended part-way through a day (e.g. by `latest`) is
+        loaded again in full.
+
+        Only yesterday's month and the one before are carried on from. If
+        the last load was before then, yesterday's month is loaded in full
+        rather than every month since.
+
+        The long tail of the breakdowns is cut off in each day's figures
+        rather than the month's, so they can differ a little from a full
+        load of the month.
+        '''
+        if self.period != 'monthly':
+            raise NotImplementedError
+        yesterday = datetime.datetime.combine(
+            datetime.date.today() - datetime.timedelta(days=1), datetime.time())
+        first_of_month = datetime.datetime(yesterday.year, yesterday.month, 1)
+        previous_month = first_of_month - datetime.timedelta(days=1)
+        mark = ga_model.get_load_mark(yesterday.strftime(FORMAT_MONTH))
+        marked_period = None
+        if mark is None or mark[0] < previous_month.strftime(FORMAT_MONTH):
+            first_day = first_of_month
+        elif mark[1] is None:
+            first_day = datetime.datetime.strptime(mark[0], FORMAT_MONTH)
+        else:
+            marked_period, loaded_through = mark
+            first_day = datetime.datetime.combine(
+                loaded_through + datetime.timedelta(days=1), datetime.time())
+        if first_day > yesterday:
+            log.info('Already loaded up to %s', yesterday.strftime('%Y-%m-%d'))
+            return
+
+        for period_name, _, first_of_month, last_of_month in \
+                self.month_periods(first_day, yesterday):
+            start_date = max(first_day, first_of_month)
+            end_date = min(yesterday, last_of_month)
+            if (end_date + datetime.timedelta(days=1)).month != end_date.month:
+                # the whole month is loaded
+                period_complete_day = 0
+            else:
+                period_complete_day = end_date.day
+            period = (period_name, period_complete_day, start_date, end_date)
+            self.download_and_store([period], popularity=False,
+                                    additive=period_name == marked_period)
+
+        if not self.skip_url_stats:
+            log.info('Updating dataset popularity scores')
+            ga_model.update_popularity_scores()
+
 
     def for_date(self, for_date):
-        assert isinstance(since_date, datetime.datetime)
+        assert isinstance(for_date, datetime.datetime)
+        self.download_and_store(self.month_periods(for_date))
+
+    def all_(self, processes=1):
+        '''Backfills every month since 2010.'''
+        self.backfill(datetime.datetime(2010, 1, 1), processes=processes)
+
+    def month_periods(self, first_month, last_month=None):
+        '''Returns the periods for each month from first_month to last_month
+        (default: this month) inclusive. The current month only goes up
+        until today.'''
         periods = [] # (period_name, period_complete_day, start_date, end_date)
         if self.period == 'monthly':
-            first_of_the_months_until_now = []
-            year = for_date.year
-            month = for_date.month
+            year = first_month.year
+            month = first_month.month
             now = datetime.datetime.now()
             first_of_this_month = datetime.datetime(now.year, now.month, 1)
+            last_month = min(last_month or now, now)
+            first_of_last_month = datetime.datetime(last_month.year, last_month.month, 1)
             while True:
                 first_of_the_month = datetime.datetime(year, month, 1)
-                if first_of_the_month == first_of_this_month:
+                if first_of_the_month > first_of_last_month:
+                    break
+                elif first_of_the_month == first_of_this_month:
                     periods.append((now.strftime(FORMAT_MONTH),
                                     now.day,
                                     first_of_this_month, now))
-                    break
-                elif first_of_the_month < first_of_this_month:
+                else:
                     in_the_next_month = first_of_the_month + datetime.timedelta(40)
                     last_of_the_month = datetime.datetime(in_the_next_month.year,
                                                            in_the_next_month.month, 1)\
                                                            - datetime.timedelta(1)
-                    periods.append((now.strftime(FORMAT_MONTH), 0,
+                    periods.append((first_of_the_month.strftime(FORMAT_MONTH), 0,
                                     first_of_the_month, last_of_the_month))
-                else:
-                    # first_of_the_month has got to the future somehow
-                    break
                 month += 1
                 if month > 12:
                     year += 1
                     month = 1
         else:
             raise NotImplementedError
-        self.download_and_store(periods)
+        return periods
+
+    def backfill(self, first_month, last_month=None, processes=1):
+        '''
+        Loads each month from first_month to last_month, skipping the ones
+        that an earlier backfill has already loaded, with up to `processes`
+        months loading at once in worker processes.
+
+        Each complete month is checkpointed in ga_load_checkpoint once it
+        has been published, so an interrupted backfill can just be run
+        again. The current month is always loaded, as it isn't complete.
+        With delete_first or replay every month is loaded, as the point is
+        to rebuild them.
+        '''
+        import ckan.model as model
+
+        ga_model.metadata.create_all(model.meta.engine)
+        if self.delete_first or self.replay:
+            loaded = set()
+        else:
+            loaded = ga_model.get_loaded_periods()
+        periods = [period for period in self.month_periods(first_month, last_month)
+                   if period[0] not in loaded]
+        log.info('Backfilling %d months (%d already loaded)',
+                 len(periods), len(loaded))
+        if not periods:
+            return
+
+        options = dict(profile_id=self.profile_id,
+                       delete_first=self.delete_first,
+                       skip_url_stats=self.skip_url_stats,
+                       replay=self.replay,
+                       quota_share=max(processes, 1))
+        jobs = [(options, period) for period in periods]
+        if processes <= 1:
+            results = [_backfill_month(job) for job in jobs]
+        else:
+            import multiprocessing
+            # The workers each connect to the database themselves, rather
+            # than sharing this process's connections.
+            model.Session.remove()
+            model.meta.engine.dispose()
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = list(pool.imap_unordered(_backfill_month, jobs))
+            finally:
+                pool.close()
+                pool.join()
+
+        failed = sorted(period_name for period_name, ok in results if not ok)
+        if failed:
+            log.error('These months failed to load and will be retried by '
+                      'the next backfill: %s', ', '.join(failed))
+
+        if not self.skip_url_stats:
+            log.info('Updating dataset popularity scores')
+            ga_model.update_popularity_scores()
 
     @staticmethod
     def get_full_period_name(period_name, period_complete_day):
@@ -104,50 +337,117 @@ class DownloadAnalytics(object):
             return period_name
 
 
-    def download_and_store(self, periods):
+    @contextlib.contextmanager
+    def _timed(self, phase):
+        '''Adds the time spent in the block to self.timings[phase].'''
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            self.timings[phase] = self.timings.get(phase, 0.0) + elapsed
+            log.debug('%s took %.2fs', phase, elapsed)
+
+    def download_and_store(self, periods, popularity=True, additive=False):
+        '''Loads the periods. With additive=True each period covers just
+        some more days of a period that has already been loaded, and they
+        are added onto it (see ga_model.publish_period). The time spent in
+        each phase is added up in self.timings.
+
+        A period is only published if all of its GA queries succeed.
+        Otherwise its live data is left as it was and the error is raised,
+        without going on to the rest of the periods.'''
+        # Built on first use and shared by all the periods in this run
+        resolver = None
         for period_name, period_complete_day, start_date, end_date in periods:
             log.info('Period "%s" (%s - %s)',
                      self.get_full_period_name(period_name, period_complete_day),
                      start_date.strftime('%Y-%m-%d'),
                      end_date.strftime('%Y-%m-%d'))
 
+            # Everything is loaded into the staging tables and only replaces
+            # the live data for the period once it is all there.
+            with self._timed('staging'):
+                ga_model.ensure_period_partitions(period_name)
+                ga_model.start_staging(period_name)
+
+            if not self.skip_url_stats and resolver is None:
+                with self._timed('resolver'):
+                    resolver = ga_model.PackagePublisherResolver()
+
+            # A query that fails gives no results and is noted in
+            # failed_fetches, so the rest of the period can still be tried,
+            # but it isn't published.
+            self.failed_fetches = []
+            try:
+                self._stage_period(period_name, period_complete_day,
+                                   start_date, end_date, resolver)
+                if self.failed_fetches:
+                    raise GAError('%d GA queries failed' % len(self.failed_fetches))
+            except Exception:
+                log.error('Not publishing the analytics for period "%s", so '
+                          'its existing analytics are kept', period_name)
+                ga_model.discard_staging(period_name)
+                raise
+
             if self.delete_first:
-                log.info('Deleting existing Analytics for this period "%s"',
+                log.info('Replacing all existing Analytics for this period "%s"',
                          period_name)
-                ga_model.delete(period_name)
-
-            if not self.skip_url_stats:
-                # Clean out old url data before storing the new
-                ga_model.pre_update_url_stats(period_name)
-
-                accountName = config.get('googleanalytics.account')
-
-                log.info('Downloading analytics for dataset views')
+            # A load that ends part-way through today hasn't loaded today
+            # (or, as the period is replaced, any day of it), so it leaves
+            # the period's mark without a date.
+            if end_date.date() < datetime.date.today():
+                loaded_through = end_date.date()
+            else:
+                loaded_through = None
+            log.info('Publishing the analytics for period "%s"', period_name)
+            with self._timed('publish'):
+                ga_model.publish_period(period_name,
+                                        url_stats=not self.skip_url_stats,
+                                        replace_all=self.delete_first and not additive,
+                                        additive=additive,
+                                        period_complete_day=period_complete_day,
+                                        loaded_through=loaded_through)
+
+            if popularity and not self.skip_url_stats:
+                log.info('Updating dataset popularity scores')
+                with self._timed('popularity'):
+                    ga_model.update_popularity_scores()
+
+            if self.client is not None and self.client.quota is not None:
+                log.info('GA quota usage: %s', self.client.quota.usage())
+
+
+    def _stage_period(self, period_name, period_complete_day, start_date,
+                      end_date, resolver):
+        '''Downloads the period's analytics into the staging tables.'''
+        if not self.skip_url_stats:
+            # The urls are downloaded as they are stored, so the two
+            # are timed together
+            log.info('Downloading and storing analytics for dataset views')
+            with self._timed('dataset views'):
                 data = self.download(start_date, end_date, '~^/data/dataset/[a-z0-9-_]+')
+                self.store(period_name, period_complete_day, data, resolver)
 
-                log.info('Storing dataset views (%i rows)', len(data.get('url')))
-                self.store(period_name, period_complete_day, data, )
-
-                log.info('Downloading analytics for publisher views')
+            log.info('Downloading and storing analytics for publisher views')
+            with self._timed('publisher views'):
                 data = self.download(start_date, end_date, '~^/data/organization/[a-z0-9-_]+')
+                self.store(period_name, period_complete_day, data, resolver)
+            resolver.log_unmatched()
 
-                log.info('Storing publisher views (%i rows)', len(data.get('url')))
-                self.store(period_name, period_complete_day, data,)
-
-                # Make sure the All records are correct.
-                ga_model.post_update_url_stats()
-
-                log.info('Associating datasets with their publisher')
-                ga_model.update_publisher_stats(period_name) # about 30 seconds.
+            log.info('Associating datasets with their publisher')
+            with self._timed('publisher stats'):
+                ga_model.update_publisher_stats(period_name, staging=True)
 
+        log.info('Downloading and storing analytics for site-wide stats')
+        with self._timed('site-wide stats'):
+            self.sitewide_stats(period_name, period_complete_day,
+                                start_date, end_date)
 
-            log.info('Downloading and storing analytics for site-wide stats')
-            self.sitewide_stats( period_name, period_complete_day )
-
-            log.info('Downloading and storing analytics for social networks')
+        log.info('Downloading and storing analytics for social networks')
+        with self._timed('social'):
             self.update_social_info(period_name, start_date, end_date)
 
-
     def update_social_info(self, period_name, start_date, end_date):
         start_date = start_date.strftime('%Y-%m-%d')
         end_date = end_date.strftime('%Y-%m-%d')
@@ -155,37 +455,22 @@ class DownloadAnalytics(object):
         metrics = 'ga:entrances'
         sort = '-ga:entrances'
 
-        try:
-            # Because of issues of invalid responses, we are going to make these requests
-            # ourselves.
-            headers = {'authorization': 'Bearer ' + self.token}
-
-            args = dict(ids='ga:' + self.profile_id,
-                       filters=query,
-                       metrics=metrics,
-                       sort=sort,
-                       dimensions="ga:landingPagePath,ga:socialNetwork")
-
-            args['max-results'] = 10000
-            args['start-date'] = start_date
-            args['end-date'] = end_date
-
-            results = self._get_json(args)
-        except Exception, e:
-            log.exception(e)
-            results = dict(url=[])
-
+        args = self._query_args(start_date, end_date,
+                                filters=query,
+                                metrics=metrics,
+                                sort=sort,
+                                dimensions="ga:landingPagePath,ga:socialNetwork")
 
         data = collections.defaultdict(list)
-        rows = results.get('rows',[])
-        for row in rows:
+        for row in self._iter_rows(args):
             url = row[0]
             data[url].append( (row[1], int(row[2]),) )
-        ga_model.update_social(period_name, data)
+        ga_model.update_social(period_name, data, staging=True)
 
 
     def download(self, start_date, end_date, path=None):
-        '''Get data from GA for a given time period'''
+        '''Get data from GA for a given time period. The urls are yielded
+        as the pages of results arrive.'''
         start_date = start_date.strftime('%Y-%m-%d')
         end_date = end_date.strftime('%Y-%m-%d')
         query = 'ga:pagePath=%s$' % path
@@ -194,58 +479,175 @@ class DownloadAnalytics(object):
 
         # Supported query params at
         # https://developers.google.com/analytics/devguides/reporting/core/v3/reference
-	# https://ga-dev-tools.appspot.com/explorer/
-        try:
-            args = {}
-            args["sort"] = "-ga:pageviews"
-            args["max-results"] = 10000
-            args["dimensions"] = "ga:pagePath"
-            args["start-date"] = start_date
-            args["end-date"] = end_date
-            args["metrics"] = metrics
-            args["sort"] = sort
-            args["ids"] = "ga:" + self.profile_id
-            args["filters"] = query
-            args["alt"] = "json"
-            print args
-            results = self._get_json(args)
-
-        except Exception, e:
-            log.exception(e)
-            return dict(url=[])
-
-        packages = []
-        log.info("There are %d results" % results['totalResults'])
-	if results['totalResults'] > 0:
-          for entry in results.get('rows'):
-            (loc,pageviews,visits) = entry
+        # https://ga-dev-tools.appspot.com/explorer/
+        args = self._query_args(start_date, end_date,
+                                dimensions="ga:pagePath",
+                                metrics=metrics,
+                                sort=sort,
+                                filters=query)
+        return dict(url=self._iter_urls(args))
+
+    def _iter_urls(self, args):
+        for loc, pageviews, visits in self._iter_rows(args):
             #url = _normalize_url('http:/' + loc) # strips off domain e.g. www.data.gov.uk or data.gov.uk
             url = loc
-	    #print url
             if not url.startswith('/data/dataset/') and not url.startswith('/data/organization/'):
                 # filter out strays like:
                 # /data/user/login?came_from=http://data.gov.uk/dataset/os-code-point-open
                 # /403.html?page=/about&from=http://data.gov.uk/publisher/planning-inspectorate
                 continue
-            packages.append( (url, pageviews, visits,) ) # Temporary hack
-        return dict(url=packages)
+            yield (url, pageviews, visits)
 
-    def store(self, period_name, period_complete_day, data):
+    def store(self, period_name, period_complete_day, data, resolver=None):
         if 'url' in data:
-            ga_model.update_url_stats(period_name, period_complete_day, data['url'])
-
-    def sitewide_stats(self, period_name, period_complete_day):
+            ga_model.update_url_stats(period_name, period_complete_day, data['url'],
+                                      resolver, staging=True)
+
+    def sitewide_stats(self, period_name, period_complete_day,
+                       start_date=None, end_date=None):
+        '''Stores the site-wide stats for the period, or for just the days
+        from start_date to end_date of it. The Totals, which can't be added
+        up day by day, are always for the period up to end_date.'''
         import calendar
         year, month = period_name.split('-')
         _, last_day_of_month = calendar.monthrange(int(year), int(month))
 
-        start_date = '%s-01' % period_name
-        end_date = '%s-%s' % (period_name, last_day_of_month)
-        funcs = ['_totals_stats', '_social_stats', '_os_stats',
-                 '_locale_stats', '_browser_stats', '_mobile_stats', '_download_stats']
-        for f in funcs:
-            log.info('Downloading analytics for %s' % f.split('_')[1])
-            getattr(self, f)(start_date, end_date, period_name, period_complete_day)
+        month_start = '%s-01' % period_name
+        if start_date:
+            start_date = start_date.strftime('%Y-%m-%d')
+            end_date = end_date.strftime('%Y-%m-%d')
+        else:
+            start_date = month_start
+            end_date = '%s-%s' % (period_name, last_day_of_month)
+        families = ['totals', 'social', 'os', 'locale', 'browser', 'mobile', 'download']
+
+        # Each family of stats needs one or more GA queries, which don't
+        # depend on each other, so they are all fetched up front (in
+        # parallel if ga-report.fetch_concurrency allows). The results are
+        # then stored one family at a time, in order, on this thread.
+        queries = []
+        for family in families:
+            if family in BREAKDOWNS:
+                family_queries = self._breakdown_queries(family, start_date, end_date)
+            elif family == 'totals':
+                family_queries = self._totals_queries(month_start, end_date)
+            else:
+                family_queries = getattr(self, '_%s_queries' % family)(start_date, end_date)
+            for args in family_queries:
+                queries.append((family, args))
+        log.info('Downloading analytics for %s', ', '.join(families))
+        results = self._fetch_all([args for family, args in queries])
+
+        for family in families:
+            log.info('Storing analytics for %s', family)
+            # any pages after the first are fetched as they are needed
+            family_results = [self._iter_rows(args, result)
+                              for (name, args), result in zip(queries, results)
+                              if name == family]
+            if family in BREAKDOWNS:
+                self._breakdown_stats(family, period_name, period_complete_day,
+                                      family_results)
+            else:
+                getattr(self, '_%s_stats' % family)(period_name, period_complete_day,
+                                                    family_results)
+
+    def _fetch_all(self, queries):
+        """Runs each of the GA queries and returns their results in the same
+        order. Up to ga-report.fetch_concurrency of them are run at once.
+        With ga-report.batch_requests, queries for the same dates are sent
+        together, as few requests as the API allows."""
+        if asbool(config.get('ga-report.batch_requests', False)):
+            batches = [queries[i:i + MAX_BATCH_SIZE]
+                       for i in range(0, len(queries), MAX_BATCH_SIZE)]
+            fetch = self._fetch_batch
+        else:
+            batches = queries
+            fetch = self._fetch
+        concurrency = min(int(config.get('ga-report.fetch_concurrency', 1)),
+                          len(batches))
+        if concurrency <= 1:
+            results = [fetch(batch) for batch in batches]
+        else:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(concurrency)
+            try:
+                results = pool.map(fetch, batches)
+            finally:
+                pool.close()
+                pool.join()
+
+        if fetch == self._fetch_batch:
+            results = [result for batch_results in results
+                       for result in batch_results]
+        return results
+
+    def _fetch_batch(self, queries):
+        client = self._get_client()
+        try:
+            return client.batch_get(queries)
+        except (QuotaExceeded, CacheMiss):
+            # Fetching them one at a time wouldn't get any further
+            raise
+        except Exception, e:
+            log.exception(e)
+            # fall back to fetching them one at a time
+            return [self._fetch(args) for args in queries]
+
+    def _fetch(self, args, required=False):
+        '''The results of a GA query, or no results if it fails, in which
+        case it is added to failed_fetches. With required=True a failure
+        raises GAError instead.'''
+        try:
+            results = self._get_json(args)
+        except (QuotaExceeded, CacheMiss):
+            # Stop the load rather than storing it with data missing
+            raise
+        except Exception, e:
+            if required:
+                raise GAError('Fetching the results from row %s failed: %s' % (
+                    args.get('start-index', 1), e))
+            log.exception(e)
+            results = None
+        if results is None:
+            if required:
+                raise GAError('Fetching the results from row %s failed' %
+                              args.get('start-index', 1))
+            self.failed_fetches.append(args)
+            results = dict(url=[])
+        return results
+
+    def _iter_rows(self, args, first_page=None):
+        """
+        Yields every row of a GA query, fetching the results PAGE_SIZE rows
+        at a time by following start-index for as long as GA says there is
+        a next page. Pass first_page if it has already been fetched.
+
+        If a page after the first can't be fetched GAError is raised, as
+        stopping there would quietly leave out the rest of the rows.
+        """
+        args = dict(args)
+        start_index = int(args.get('start-index', 1))
+        results = first_page if first_page is not None else self._fetch(args)
+        while True:
+            rows = results.get('rows') or []
+            for row in rows:
+                yield row
+            if not rows or not results.get('nextLink'):
+                break
+            start_index += len(rows)
+            args['start-index'] = start_index
+            log.debug('Fetching the results from row %d', start_index)
+            results = self._fetch(args, required=True)
+
+    def _query_args(self, start_date, end_date, **args):
+        """The arguments for a GA query over the given dates."""
+        args['ids'] = 'ga:' + self.profile_id
+        args['start-date'] = start_date
+        args['end-date'] = end_date
+        args['start-index'] = 1
+        args['max-results'] = PAGE_SIZE
+        args['alt'] = 'json'
+        return args
 
     def _get_results(result_data, f):
         data = {}
@@ -254,369 +656,154 @@ class DownloadAnalytics(object):
             data[key] = data.get(key,0) + result[1]
         return data
 
-    def _get_json(self, params, prev_fail=False):
-        ga_token_filepath = os.path.expanduser(config.get('googleanalytics.token.filepath', ''))
-        if not ga_token_filepath:
-            print 'ERROR: In the CKAN config you need to specify the filepath of the ' \
-                'Google Analytics token file under key: googleanalytics.token.filepath'
+    def _get_client(self):
+        """The GA client, shared by all the requests (and threads) of this
+        downloader."""
+        with self._client_lock:
+            if self.client is None and self.replay:
+                # Everything comes from the response cache
+                self.client = GA(None, cache=get_response_cache(), replay=True)
+            elif self.client is None:
+                ga_token_filepath = os.path.expanduser(config.get('googleanalytics.token.filepath', ''))
+                if not ga_token_filepath:
+                    print 'ERROR: In the CKAN config you need to specify the filepath of the ' \
+                        'Google Analytics token file under key: googleanalytics.token.filepath'
+                    return
+                # The token is only refreshed when it is about to expire
+                from ga_auth import get_token_cache
+                self.client = GA(get_token_cache(ga_token_filepath),
+                                 api_url=config.get('ga-report.api_url', API_URL),
+                                 batch_url=config.get('ga-report.batch_url', BATCH_URL),
+                                 timeout=int(config.get('ga-report.timeout', 60)),
+                                 retries=int(config.get('ga-report.retries', 5)),
+                                 quota=get_quota_scheduler(self.quota_share),
+                                 cache=get_response_cache())
+            return self.client
+
+    def _get_json(self, params):
+        client = self._get_client()
+        if client is None:
             return
+        return client.get(params)
 
-        log.info("Trying to refresh our OAuth token")
-        try:
-            from ga_auth import init_service
-            self.token, svc = init_service(ga_token_filepath, None)
-            log.info("OAuth token refreshed")
-        except Exception, auth_exception:
-            log.error("Oauth refresh failed")
-            log.exception(auth_exception)
+    def _totals_queries(self, start_date, end_date):
+        # Bounces from / or another configurable page.
+        path = '/' #% (config.get('googleanalytics.account'),                          config.get('ga-report.bounce_url', '/'))
+        return [
+            self._query_args(start_date, end_date,
+                             metrics='ga:pageviews',
+                             sort='-ga:pageviews'),
+            self._query_args(start_date, end_date,
+                             metrics='ga:pageviewsPerVisit,ga:avgTimeOnSite,ga:percentNewVisits,ga:visits'),
+            self._query_args(start_date, end_date,
+                             filters='ga:pagePath==%s' % (path,),
+                             dimensions='ga:pagePath',
+                             metrics='ga:visitBounceRate'),
+        ]
+
+    def _totals_stats(self, period_name, period_complete_day, results):
+        """ Stores distinct totals, total pageviews etc """
+        views, visits, bounce = [list(rows) for rows in results]
+        if not views or not visits:
+            log.error('No totals for the period. Got results: %r, %r', views, visits)
             return
 
-        try:
-            headers = {'authorization': 'Bearer ' + self.token}
-            r = requests.get("https://www.googleapis.com/analytics/v3/data/ga", params=params, headers=headers)
-            if r.status_code != 200:
-                log.info("STATUS: %s" % (r.status_code,))
-                log.info("CONTENT: %s" % (r.content,))
-                raise Exception("Request with params: %s failed" % params)
-
-            return json.loads(r.content)
-        except Exception, e:
-              log.exception(e)
-
-        return dict(url=[])
-
-    def _totals_stats(self, start_date, end_date, period_name, period_complete_day):
-        """ Fetches distinct totals, total pageviews etc """
-        try:
-            args = {}
-            args["max-results"] = 10000
-            args["start-date"] = start_date
-            args["end-date"] = end_date
-            args["ids"] = "ga:" + self.profile_id
-
-            args["metrics"] = "ga:pageviews"
-            args["sort"] = "-ga:pageviews"
-            args["alt"] = "json"
-
-            results = self._get_json(args)
-        except Exception, e:
-            log.exception(e)
-            results = dict(url=[])
-
-        result_data = results.get('rows')
+        result_data = views
         ga_model.update_sitewide_stats(period_name, "Totals", {'Total page views': result_data[0][0]},
-            period_complete_day)
-
-        try:
-            # Because of issues of invalid responses, we are going to make these requests
-            # ourselves.
-            headers = {'authorization': 'Bearer ' + self.token}
-
-            args = {}
-            args["max-results"] = 10000
-            args["start-date"] = start_date
-            args["end-date"] = end_date
-            args["ids"] = "ga:" + self.profile_id
-
-            args["metrics"] = "ga:pageviewsPerVisit,ga:avgTimeOnSite,ga:percentNewVisits,ga:visits"
-            args["alt"] = "json"
-
-            results = self._get_json(args)
-        except Exception, e:
-            log.exception(e)
-            results = dict(url=[])
+            period_complete_day, staging=True)
 
-        result_data = results.get('rows')
+        result_data = visits
         data = {
             'Pages per visit': result_data[0][0],
             'Average time on site': result_data[0][1],
             'New visits': result_data[0][2],
             'Total visits': result_data[0][3],
         }
-        ga_model.update_sitewide_stats(period_name, "Totals", data, period_complete_day)
-
-        # Bounces from / or another configurable page.
-        path = '/' #% (config.get('googleanalytics.account'),                          config.get('ga-report.bounce_url', '/'))
-
-        try:
-            # Because of issues of invalid responses, we are going to make these requests
-            # ourselves.
-            headers = {'authorization': 'Bearer ' + self.token}
-
-            args = {}
-            args["max-results"] = 10000
-            args["start-date"] = start_date
-            args["end-date"] = end_date
-            args["ids"] = "ga:" + self.profile_id
+        ga_model.update_sitewide_stats(period_name, "Totals", data, period_complete_day, staging=True)
 
-            args["filters"] = 'ga:pagePath==%s' % (path,)
-            args["dimensions"] = 'ga:pagePath'
-            args["metrics"] = "ga:visitBounceRate"
-            args["alt"] = "json"
-
-            results = self._get_json(args)
-        except Exception, e:
-            log.exception(e)
-            results = dict(url=[])
-
-        result_data = results.get('rows')
+        result_data = bounce
         if not result_data or len(result_data) != 1:
-            log.error('Could not pinpoint the bounces for path: %s. Got results: %r',
-                      path, result_data)
+            log.error('Could not pinpoint the bounces for the home page. Got results: %r',
+                      result_data)
             return
         results = result_data[0]
         bounces = float(results[1])
         # visitBounceRate is already a %
         log.info('Google reports visitBounceRate as %s', bounces)
         ga_model.update_sitewide_stats(period_name, "Totals", {'Bounce rate (home page)': float(bounces)},
-            period_complete_day)
+            period_complete_day, staging=True)
 
 
-    def _locale_stats(self, start_date, end_date, period_name, period_complete_day):
-        """ Fetches stats about language and country """
+    def _breakdown_queries(self, family, start_date, end_date):
+        dimensions, specs = BREAKDOWNS[family]
+        return [self._query_args(start_date, end_date,
+                                 metrics='ga:pageviews',
+                                 sort='-ga:pageviews',
+                                 dimensions=dimensions)]
 
-        try:
-            # Because of issues of invalid responses, we are going to make these requests
-            # ourselves.
-            headers = {'authorization': 'Bearer ' + self.token}
+    def _breakdown_stats(self, family, period_name, period_complete_day, results):
+        """ Stores the breakdowns of page views in the family """
+        dimensions, specs = BREAKDOWNS[family]
+        ga_model.update_sitewide_stats_many(period_name,
+                                            aggregate_breakdowns(specs, results[0]),
+                                            period_complete_day, staging=True)
 
-            args = {}
-            args["max-results"] = 10000
-            args["start-date"] = start_date
-            args["end-date"] = end_date
-            args["ids"] = "ga:" + self.profile_id
 
-            args["dimensions"] = "ga:language,ga:country"
-            args["metrics"] = "ga:pageviews"
-            args["sort"] = "-ga:pageviews"
-            args["alt"] = "json"
-
-            results = self._get_json(args)
-        except Exception, e:
-            log.exception(e)
-            results = dict(url=[])
-
-        result_data = results.get('rows')
-        data = {}
-        for result in result_data:
-            data[result[0]] = data.get(result[0], 0) + int(result[2])
-        self._filter_out_long_tail(data, MIN_VIEWS)
-        ga_model.update_sitewide_stats(period_name, "Languages", data, period_complete_day)
-
-        data = {}
-        for result in result_data:
-            data[result[1]] = data.get(result[1], 0) + int(result[2])
-        self._filter_out_long_tail(data, MIN_VIEWS)
-        ga_model.update_sitewide_stats(period_name, "Country", data, period_complete_day)
-
-
-    def _download_stats(self, start_date, end_date, period_name, period_complete_day):
-        """ Fetches stats about data downloads """
-        import ckan.model as model
+    def _download_queries(self, start_date, end_date):
+        return [self._query_args(start_date, end_date,
+                                 filters='ga:eventAction==download,ga:eventAction==internal,ga:eventAction==outbound',
+                                 dimensions='ga:eventLabel',
+                                 metrics='ga:totalEvents',
+                                 sort='-ga:totalEvents')]
 
+    def _download_stats(self, period_name, period_complete_day, results):
+        """ Stores stats about data downloads """
         data = {}
         data_org = {}
 
-        try:
-            # Because of issues of invalid responses, we are going to make these requests
-            # ourselves.
-            headers = {'authorization': 'Bearer ' + self.token}
-
-            args = {}
-            args["max-results"] = 10000
-            args["start-date"] = start_date
-            args["end-date"] = end_date
-            args["ids"] = "ga:" + self.profile_id
-
-            args["filters"] = 'ga:eventAction==download,ga:eventAction==internal,ga:eventAction==outbound'
-            args["dimensions"] = "ga:eventLabel"
-            args["metrics"] = "ga:totalEvents"
-            args["sort"] = "-ga:totalEvents"
-            args["alt"] = "json"
+        if self.resource_index is None:
+            # Built on first use and shared by all the periods in this run
+            self.resource_index = ga_model.ResourceAttributionIndex()
 
-            results = self._get_json(args)
-        except Exception, e:
-            log.exception(e)
-            results = dict(url=[])
-
-        result_data = results.get('rows')
-        if not result_data:
-            # We may not have data for this time period, so we need to bail
-            # early.
-            log.info("There is no download data for this time period")
-            return
-
-        def process_result_data(result_data, cached=False):
-            progress_total = len(result_data)
+        def process_result_data(result_data):
             progress_count = 0
             resources_not_matched = []
             for result in result_data:
                 progress_count += 1
                 if progress_count % 100 == 0:
-                    log.debug('.. %d/%d done so far', progress_count, progress_total)
+                    log.debug('.. %d done so far', progress_count)
                 if 'linktext=download' in result[0] or 'linktext=order resource' in result[0] or 'linktext=view data tool' in result[0]:
                     linkhref = re.search('linkhref(=.*data.vic.gov.au|=.*links.com.au|=)(.*?)&linkdiv',result[0].strip())
                     if linkhref:
                         url = linkhref.group(2)
 
-                        # Get package id associated with the resource that has this URL.
-                        q = model.Session.query(model.Resource)
-                        if cached:
-                            r = q.filter(model.Resource.cache_url.ilike("%%%s%%" % url)).first()
-                        else:
-                            r = q.filter(model.Resource.url.ilike("%%%s%%" % url)).first()
-
-                        # new style internal download links
-                        if re.search('(?:\/resource\/)(.*)(?:\/download\/)', url):
-                            resource_id = re.search('(?:\/resource\/)(.*)(?:\/download\/)', url)
-                            r = q.filter(model.Resource.id == resource_id.group(1)).first()
-                            if not r:
-                                filename = re.search('(.files.*)', url)
-                                if filename:
-                                    sql = "SELECT distinct id FROM public.resource t " \
-                                          "WHERE replace(url,'-','') ilike '%"+filename.group(1)+"%' or url ilike '%"+filename.group(1)+"%' " \
-                                          "UNION SELECT distinct id FROM public.resource_revision t " \
-                                          "WHERE replace(url,'-','') ilike '%"+filename.group(1)+"%' or url ilike '%"+filename.group(1)+"%' "
-                                    res = model.Session.execute(sql).first()
-                                    if res:
-                                        resource_id = res[0]
-                                        r = q.filter(model.Resource.id == resource_id).first()
-                            if not r:
-                                filename = re.search('(\w+\.\w+$)', url)
-                                if filename:
-                                    sql = "SELECT distinct id FROM public.resource t " \
-                                          "WHERE replace(url,'-','') ilike '%"+filename.group(1)+"%' or url ilike '%"+filename.group(1)+"%' " \
-                                          "UNION SELECT distinct id FROM public.resource_revision t " \
-                                          "WHERE replace(url,'-','') ilike '%"+filename.group(1)+"%' or url ilike '%"+filename.group(1)+"%' "
-                                    res = model.Session.execute(sql).first()
-                                    if res:
-                                        resource_id = res[0]
-                                        r = q.filter(model.Resource.id == resource_id).first()
-
-                        package_name = r.resource_group.package.name if r else ""
-
-                        if package_name:
+                        # Get the dataset and organization of the resource
+                        # that has this URL.
+                        entry = self.resource_index.resolve(url)
+                        if entry:
+                            package_name, owner_org = entry
                             data[package_name] = data.get(package_name, 0) + int(result[1])
-                            if r.resource_group.package.owner_org:
-                                owner_org = model.Group.get(r.resource_group.package.owner_org).name
+                            if owner_org:
                                 data_org[owner_org] = data_org.get(owner_org, 0) + int(result[1])
                         else:
                             resources_not_matched.append(url)
                             continue
             if resources_not_matched:
                     log.debug('Could not match %i or %i resource URLs to datasets. e.g. %r',
-                              len(resources_not_matched), progress_total, resources_not_matched)
+                              len(resources_not_matched), progress_count, resources_not_matched[:10])
+            return progress_count
 
         log.info('Associating downloads of resource URLs with their respective datasets')
-        process_result_data(results.get('rows'))
+        if not process_result_data(results[0]):
+            # We may not have data for this time period
+            log.info("There is no download data for this time period")
+            return
 
         self._filter_out_long_tail(data, MIN_DOWNLOADS)
-        ga_model.update_sitewide_stats(period_name, "Downloads", data, period_complete_day)
-        ga_model.update_sitewide_stats(period_name, "Downloads by Organisation", data_org, period_complete_day)
-
-    def _social_stats(self, start_date, end_date, period_name, period_complete_day):
-        """ Finds out which social sites people are referred from """
-
-        try:
-            # Because of issues of invalid responses, we are going to make these requests
-            # ourselves.
-            headers = {'authorization': 'Bearer ' + self.token}
-
-            args = dict( ids='ga:' + self.profile_id,
-                         metrics='ga:pageviews',
-                         sort='-ga:pageviews',
-                         dimensions="ga:socialNetwork,ga:referralPath")
-            args['max-results'] = 10000
-            args['start-date'] = start_date
-            args['end-date'] = end_date
-
-            results = self._get_json(args)
-        except Exception, e:
-            log.exception(e)
-            results = dict(url=[])
-
-        result_data = results.get('rows')
-        data = {}
-        for result in result_data:
-            if not result[0] == '(not set)':
-                data[result[0]] = data.get(result[0], 0) + int(result[2])
-        self._filter_out_long_tail(data, 3)
-        ga_model.update_sitewide_stats(period_name, "Social sources", data, period_complete_day)
-
-
-    def _os_stats(self, start_date, end_date, period_name, period_complete_day):
-        """ Operating system stats """
-        try:
-            # Because of issues of invalid responses, we are going to make these requests
-            # ourselves.
-            headers = {'authorization': 'Bearer ' + self.token}
-
-            args = dict( ids='ga:' + self.profile_id,
-                         metrics='ga:pageviews',
-                         sort='-ga:pageviews',
-                         dimensions="ga:operatingSystem,ga:operatingSystemVersion")
-            args['max-results'] = 10000
-            args['start-date'] = start_date
-            args['end-date'] = end_date
-
-            results = self._get_json(args)
-        except Exception, e:
-            log.exception(e)
-            results = dict(url=[])
-
-        result_data = results.get('rows')
-        data = {}
-        for result in result_data:
-            data[result[0]] = data.get(result[0], 0) + int(result[2])
-        self._filter_out_long_tail(data, MIN_VIEWS)
-        ga_model.update_sitewide_stats(period_name, "Operating Systems", data, period_complete_day)
-
-        data = {}
-        for result in result_data:
-            if int(result[2]) >= MIN_VIEWS:
-                key = "%s %s" % (result[0],result[1])
-                data[key] = result[2]
-        ga_model.update_sitewide_stats(period_name, "Operating Systems versions", data, period_complete_day)
-
-
-    def _browser_stats(self, start_date, end_date, period_name, period_complete_day):
-        """ Information about browsers and browser versions """
-
-        try:
-            # Because of issues of invalid responses, we are going to make these requests
-            # ourselves.
-            headers = {'authorization': 'Bearer ' + self.token}
-
-            args = dict( ids='ga:' + self.profile_id,
-                         metrics='ga:pageviews',
-                         sort='-ga:pageviews',
-                         dimensions="ga:browser,ga:browserVersion")
-
-            args['max-results'] = 10000
-            args['start-date'] = start_date
-            args['end-date'] = end_date
-
-            results = self._get_json(args)
-        except Exception, e:
-            log.exception(e)
-            results = dict(url=[])
-
-
-        result_data = results.get('rows')
-        # e.g. [u'Firefox', u'19.0', u'20']
-
-        data = {}
-        for result in result_data:
-            data[result[0]] = data.get(result[0], 0) + int(result[2])
-        self._filter_out_long_tail(data, MIN_VIEWS)
-        ga_model.update_sitewide_stats(period_name, "Browsers", data, period_complete_day)
-
-        data = {}
-        for result in result_data:
-            key = "%s %s" % (result[0], self._filter_browser_version(result[0], result[1]))
-            data[key] = data.get(key, 0) + int(result[2])
-        self._filter_out_long_tail(data, MIN_VIEWS)
-        ga_model.update_sitewide_stats(period_name, "Browser versions", data, period_complete_day)
+        ga_model.update_sitewide_stats_many(period_name,
+                                            {"Downloads": data,
+                                             "Downloads by Organisation": data_org},
+                                            period_complete_day, staging=True)
 
     @classmethod
     def _filter_browser_version(cls, browser, version_str):
@@ -640,42 +827,6 @@ class DownloadAnalytics(object):
                 ver = ver[0] + ver[1] + 'X' * num_hidden_digits
         return ver
 
-    def _mobile_stats(self, start_date, end_date, period_name, period_complete_day):
-        """ Info about mobile devices """
-
-        try:
-            # Because of issues of invalid responses, we are going to make these requests
-            # ourselves.
-            headers = {'authorization': 'Bearer ' + self.token}
-
-            args = dict( ids='ga:' + self.profile_id,
-                         metrics='ga:pageviews',
-                         sort='-ga:pageviews',
-                         dimensions="ga:mobileDeviceBranding, ga:mobileDeviceInfo")
-
-            args['max-results'] = 10000
-            args['start-date'] = start_date
-            args['end-date'] = end_date
-
-            results = self._get_json(args)
-        except Exception, e:
-            log.exception(e)
-            results = dict(url=[])
-
-
-        result_data = results.get('rows')
-        data = {}
-        for result in result_data:
-            data[result[0]] = data.get(result[0], 0) + int(result[2])
-        self._filter_out_long_tail(data, MIN_VIEWS)
-        ga_model.update_sitewide_stats(period_name, "Mobile brands", data, period_complete_day)
-
-        data = {}
-        for result in result_data:
-            data[result[1]] = data.get(result[1], 0) + int(result[2])
-        self._filter_out_long_tail(data, MIN_VIEWS)
-        ga_model.update_sitewide_stats(period_name, "Mobile devices", data, period_complete_day)
-
     @classmethod
     def _filter_out_long_tail(cls, data, threshold=10):
         '''
@@ -0,0 +1,276 @@
+'''
+A stand-in for the Google Analytics APIs, for tests and benchmarks.
+
+FakeGA makes up analytics for a site with a given number of datasets,
+organizations and download events, and answers the queries that
+DownloadAnalytics makes with them. The same seed always gives the same
+answers, and each month has different (but repeatable) figures.
+FakeGAServer serves a FakeGA over HTTP, as the Core Reporting API v3
+(data/ga) and the Reporting API v4 (reports:batchGet), in a thread.
+FakeService and StaticToken stand in for the API service that
+ga_auth.get_profile_id uses and for the oauth token cache.
+'''
+import json
+import random
+import logging
+import threading
+import urlparse
+import BaseHTTPServer
+
+
+log = logging.getLogger('ckanext.ga-report')
+
+PROFILE_ID = '12345678'
+
+BROWSERS = ['Chrome', 'Firefox', 'Safari', 'Internet Explorer', 'Opera']
+SYSTEMS = ['Windows', 'Macintosh', 'Linux', 'iOS', 'Android']
+LANGUAGES = ['en-us', 'en-gb', 'en-au', 'zh-cn', 'fr', 'de']
+COUNTRIES = ['Australia', 'United States', 'United Kingdom', 'China', 'India']
+NETWORKS = ['Facebook', 'Twitter', 'LinkedIn', 'reddit', '(not set)']
+BRANDS = ['Apple', 'Samsung', 'Google', 'Sony', '(not set)']
+
+
+class FakeGA(object):
+    '''
+    Synthetic analytics, and the answers to GA queries about them.
+
+    There are views of `datasets` dataset pages and `organizations`
+    organization pages, and `downloads` different resources are downloaded.
+    The names and resource ids are made up unless they are given, e.g. from
+    a real site so that the urls resolve to its datasets.
+
+    Queries by any of the dimensions in `failing` (as they appear in the
+    query, e.g. 'ga:pagePath') fail, with a 500 from FakeGAServer.
+    '''
+
+    def __init__(self, datasets=1000, organizations=50, downloads=5000,
+                 seed=0, dataset_names=None, organization_names=None,
+                 resource_ids=None):
+        self.seed = seed
+        self.failing = set()
+        rand = random.Random(seed)
+        self.datasets = list(dataset_names or [])[:datasets]
+        self.datasets += ['dataset-%d' % i
+                          for i in range(len(self.datasets), datasets)]
+        self.organizations = list(organization_names or [])[:organizations]
+        self.organizations += ['organization-%d' % i
+                               for i in range(len(self.organizations), organizations)]
+        resource_ids = list(resource_ids or [])
+        self.downloads = []
+        for i in range(downloads):
+            if i < len(resource_ids):
+                resource_id = resource_ids[i]
+            else:
+                resource_id = '%08x-0000-0000-0000-%012x' % (rand.getrandbits(32), i)
+            dataset = rand.choice(self.datasets) if self.datasets else 'dataset'
+            self.downloads.append(
+                'linktext=download&linkhref=/data/dataset/%s/resource/%s'
+                '/download/file-%d.csv&linkdiv=resource' % (dataset, resource_id, i))
+
+    def _random(self, params):
+        # The same figures for the same query and dates
+        return random.Random('%s %s %s %s' % (self.seed, params.get('start-date'),
+                                              params.get('end-date'),
+                                              params.get('dimensions')))
+
+    def _rows(self, params):
+        rand = self._random(params)
+        dimensions = [d.strip() for d in params.get('dimensions', '').split(',')
+                      if d.strip()]
+        metrics = [m.strip() for m in params['metrics'].split(',')]
+        filters = params.get('filters', '')
+
+        def views():
+            return str(rand.randint(1, 5000))
+
+        if dimensions == ['ga:pagePath'] and 'ga:visitBounceRate' in metrics:
+            return [['/', '%.2f' % rand.uniform(20, 80)]]
+        if dimensions == ['ga:pagePath']:
+            if 'organization' in filters:
+                urls = ['/data/organization/%s' % name for name in self.organizations]
+            else:
+                urls = ['/data/dataset/%s' % name for name in self.datasets]
+            rows = []
+            for url in urls:
+                pageviews = rand.randint(1, 5000)
+                rows.append([url, str(pageviews), str(rand.randint(1, pageviews))])
+            return rows
+        if dimensions == ['ga:eventLabel']:
+            return [[label, str(rand.randint(1, 50))] for label in self.downloads]
+        if dimensions == ['ga:landingPagePath', 'ga:socialNetwork']:
+            return [['/data/dataset/%s' % rand.choice(self.datasets), network, views()]
+                    for network in NETWORKS[:-1] for i in range(10)]
+        if not dimensions:
+            if len(metrics) == 1:
+                return [[views()]]
+            return [['%.2f' % rand.uniform(1, 5), '%.2f' % rand.uniform(30, 300),
+                     '%.2f' % rand.uniform(20, 80), views()]]
+
+        values = {
+            'ga:socialNetwork': NETWORKS, 'ga:referralPath': ['/', '/home', '/news'],
+            'ga:operatingSystem': SYSTEMS, 'ga:operatingSystemVersion': ['1', '2', '10'],
+            'ga:language': LANGUAGES, 'ga:country': COUNTRIES,
+            'ga:browser': BROWSERS, 'ga:browserVersion': ['9.0', '10.0.1', '534.55.3'],
+            'ga:mobileDeviceBranding': BRANDS, 'ga:mobileDeviceInfo': ['Phone', 'Tablet'],
+        }
+        rows = [[]]
+        for dimension in dimensions:
+            rows = [row + [value] for row in rows
+                    for value in values.get(dimension, ['(not set)'])]
+        return [row + [views()] for row in rows]
+
+    def query(self, params):
+        '''The Core Reporting API (v3) response to a query, one page of
+        max-results rows from start-index.'''
+        if params.get('dimensions') in self.failing:
+            raise ValueError('Failing query by %s' % params['dimensions'])
+        rows = self._rows(params)
+        start = int(params.get('start-index', 1)) - 1
+        page_size = int(params.get('max-results', 1000))
+        results = {'totalResults': len(rows),
+                   'rows': rows[start:start + page_size]}
+        if start + page_size < len(rows):
+            results['nextLink'] = 'start-index=%d' % (start + page_size + 1)
+        return results
+
+    def batch_get(self, body):
+        '''The Reporting API v4 response to a batchGet request.'''
+        reports = []
+        for request in body['reportRequests']:
+            params = {
+                'ids': 'ga:' + request['viewId'],
+                'start-date': request['dateRanges'][0]['startDate'],
+                'end-date': request['dateRanges'][0]['endDate'],
+                'metrics': ','.join(m['expression'] for m in request['metrics']),
+                'dimensions': ','.join(d['name'] for d in request.get('dimensions', [])),
+                'filters': request.get('filtersExpression', ''),
+                'max-results': request.get('pageSize', 1000),
+                'start-index': int(request.get('pageToken', 0)) + 1,
+            }
+            results = self.query(params)
+            dimension_count = len(request.get('dimensions', []))
+            report = {'data': {
+                'rowCount': results['totalResults'],
+                'rows': [{'dimensions': row[:dimension_count],
+                          'metrics': [{'values': row[dimension_count:]}]}
+                         for row in results['rows']]}}
+            if 'nextLink' in results:
+                report['nextPageToken'] = str(params['start-index'] - 1 +
+                                              len(results['rows']))
+            reports.append(report)
+        return {'reports': reports}
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def _respond(self, data):
+        content = json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        self.server.requests.append(('GET', url.path))
+        try:
+            data = self.server.fake.query(params)
+        except ValueError:
+            self.send_error(500)
+            return
+        self._respond(data)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests.append(('POST', self.path))
+        try:
+            data = self.server.fake.batch_get(body)
+        except ValueError:
+            self.send_error(500)
+            return
+        self._respond(data)
+
+    def log_message(self, format, *args):
+        log.debug('Fake GA: ' + format, *args)
+
+
+class FakeGAServer(object):
+    '''
+    Serves a FakeGA on localhost, in a thread, until stop() is called.
+    Point a ga_client.GA at api_url and batch_url. The requests made are
+    recorded in `requests`.
+    '''
+
+    def __init__(self, fake, port=0):
+        self.httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', port), _Handler)
+        self.httpd.fake = fake
+        self.httpd.requests = self.requests = []
+        host, port = self.httpd.server_address
+        self.api_url = 'http://%s:%d/analytics/v3/data/ga' % (host, port)
+        self.batch_url = 'http://%s:%d/v4/reports:batchGet' % (host, port)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class StaticToken(object):
+    '''A token cache that always has the same token.'''
+
+    def __init__(self, token='fake-token'):
+        self.token = token
+
+    def get_token(self):
+        return self.token
+
+    def invalidate(self):
+        pass
+
+
+class _Request(object):
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result
+
+
+class _Collection(object):
+    def __init__(self, items):
+        self.items = items
+
+    def list(self, **kwargs):
+        return _Request({'items': self.items})
+
+
+class FakeService(object):
+    '''
+    Enough of the analytics service that ga_auth.init_service returns for
+    ga_auth.get_profile_id to find PROFILE_ID under the account and web
+    property that are configured.
+    '''
+
+    def __init__(self, account_name, web_property_id, profile_id=PROFILE_ID):
+        self.account_name = account_name
+        self.web_property_id = web_property_id
+        self.profile_id = profile_id
+
+    def management(self):
+        return self
+
+    def accounts(self):
+        return _Collection([{'id': '1', 'name': self.account_name}])
+
+    def webproperties(self):
+        return _Collection([{'id': self.web_property_id}])
+
+    def profiles(self):
+        return _Collection([{'id': self.profile_id}])
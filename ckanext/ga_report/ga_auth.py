@@ -1,4 +1,6 @@
 import os
+import datetime
+import threading
 import httplib2
 from apiclient.discovery import build
 from oauth2client.client import flow_from_clientsecrets
@@ -39,6 +41,59 @@ def init_service(token_file, credentials_file):
     return credentials.access_token, build('analytics', 'v3', http=http)
 
 
+class TokenCache(object):
+    """
+    Holds the oauth credentials from a token file and hands out their
+    access token, refreshing it only when it is about to expire rather
+    than on every request. Safe to share between threads.
+    """
+
+    def __init__(self, token_file, credentials_file=None, margin=300):
+        self.token_file = token_file
+        self.credentials_file = credentials_file
+        # refresh this many seconds before the token expires
+        self.margin = datetime.timedelta(seconds=margin)
+        self.credentials = None
+        self._lock = threading.Lock()
+
+    def _expiring(self):
+        expiry = self.credentials.token_expiry
+        if not self.credentials.access_token:
+            return True
+        return expiry is not None and \
+            datetime.datetime.utcnow() >= expiry - self.margin
+
+    def get_token(self):
+        """Returns an access token that is valid for at least another
+        `margin` seconds."""
+        with self._lock:
+            if self.credentials is None:
+                self.credentials = _prepare_credentials(self.token_file,
+                                                        self.credentials_file)
+            if self._expiring():
+                self.credentials.refresh(httplib2.Http())
+            return self.credentials.access_token
+
+    def invalidate(self):
+        """Forces a refresh on the next call to get_token, e.g. after the
+        API has rejected the token."""
+        with self._lock:
+            if self.credentials is not None:
+                self.credentials.access_token = None
+
+
+_token_caches = {}
+_token_caches_lock = threading.Lock()
+
+
+def get_token_cache(token_file):
+    """Returns the TokenCache for the token file, shared by the process."""
+    with _token_caches_lock:
+        if token_file not in _token_caches:
+            _token_caches[token_file] = TokenCache(token_file)
+        return _token_caches[token_file]
+
+
 def get_profile_id(service):
     """
     Get the profile ID for this user and the service specified by the
@@ -0,0 +1,395 @@
+import os
+import time
+import gzip
+import json
+import random
+import hashlib
+import logging
+import datetime
+import tempfile
+import threading
+import StringIO
+
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger('ckanext.ga-report')
+
+API_URL = 'https://www.googleapis.com/analytics/v3/data/ga'
+BATCH_URL = 'https://analyticsreporting.googleapis.com/v4/reports:batchGet'
+# The most reports that batchGet accepts in one request
+MAX_BATCH_SIZE = 5
+
+# Responses that are worth trying again after a pause
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# 403 reasons that mean "slow down" rather than "not allowed"
+RETRY_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded')
+
+
+class GAError(Exception):
+    pass
+
+
+class QuotaExceeded(GAError):
+    pass
+
+
+class CacheMiss(GAError):
+    '''A response that is needed for a replay isn't in the cache.'''
+    pass
+
+
+def pacific_date(timestamp):
+    """The date in US Pacific time, when GA's daily quotas reset, at a
+    time.time() timestamp. Follows the US daylight saving rules in force
+    since 2007, so that it doesn't need pytz."""
+    utc = datetime.datetime.utcfromtimestamp(timestamp)
+    # Daylight saving time starts at 2am PST (10:00 UTC) on the second
+    # Sunday in March and ends at 2am PDT (09:00 UTC) on the first Sunday
+    # in November
+    march = datetime.datetime(utc.year, 3, 8)
+    starts = march + datetime.timedelta(days=(6 - march.weekday()) % 7, hours=10)
+    november = datetime.datetime(utc.year, 11, 1)
+    ends = november + datetime.timedelta(days=(6 - november.weekday()) % 7, hours=9)
+    offset = 7 if starts <= utc < ends else 8
+    return (utc - datetime.timedelta(hours=offset)).date()
+
+
+class QuotaScheduler(object):
+    """
+    Keeps requests within Google Analytics' quotas, so that they aren't
+    refused with rate limit errors.
+
+    Requests per second are limited with a token bucket, refilled at
+    `per_second` tokens a second up to `burst` tokens (default: a second's
+    worth). Each request takes as many tokens as it costs, and waits until
+    they are there. Tokens are taken in the order requests arrive, so
+    concurrent requests queue up behind each other rather than racing.
+
+    Requests per day are limited to `per_day` (None for no limit), counted
+    from midnight US Pacific time, as GA does. Once they are used up, acquire raises QuotaExceeded
+    instead of waiting for tomorrow.
+
+    Safe to share between threads. Each process has its own scheduler.
+    """
+
+    def __init__(self, per_second=10, per_day=None, burst=None,
+                 clock=time.time, sleep=time.sleep):
+        self.per_second = float(per_second)
+        self.per_day = per_day
+        self.burst = float(burst or per_second)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.updated = clock()
+        self.day = self._day(self.updated)
+        self.used_today = 0
+        self.used = 0
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _day(now):
+        return pacific_date(now)
+
+    def acquire(self, cost=1):
+        """Waits until a request costing `cost` fits in the quotas, and
+        counts it against them."""
+        with self._lock:
+            now = self.clock()
+            if self._day(now) != self.day:
+                self.day = self._day(now)
+                self.used_today = 0
+            if self.per_day is not None and self.used_today + cost > self.per_day:
+                raise QuotaExceeded('The daily quota of %d GA requests has been '
+                                    'used up' % self.per_day)
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated) * self.per_second)
+            self.updated = now
+            # Taking the tokens now, even if it leaves the bucket owing
+            # some, reserves this request's place in the queue
+            self.tokens -= cost
+            delay = -self.tokens / self.per_second if self.tokens < 0 else 0
+            self.used_today += cost
+            self.used += cost
+            self.waited += delay
+        if delay:
+            self.sleep(delay)
+
+    def usage(self):
+        """How much of the quotas has been used, and how long requests
+        have been held up to keep within them (in seconds)."""
+        with self._lock:
+            return {'used': self.used,
+                    'used_today': self.used_today,
+                    'remaining_today': (None if self.per_day is None
+                                        else self.per_day - self.used_today),
+                    'waited': self.waited}
+
+
+class ResponseCache(object):
+    """
+    Stores GA responses on disk, gzipped, keyed by a hash of the request
+    parameters, so that a load can be replayed later without the network.
+    The profile id that the responses are for is stored alongside them.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @staticmethod
+    def key(params):
+        """A hash of the parameters that doesn't depend on their order or
+        on whether the values are numbers or strings."""
+        canonical = sorted((unicode(k), unicode(v)) for k, v in params.items())
+        return hashlib.sha1(json.dumps(canonical)).hexdigest()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name[:2], name + '.json.gz')
+
+    def _write(self, path, content):
+        # Written to a temporary file and renamed into place, so readers
+        # never see half a file
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # another thread got there first
+                if not os.path.isdir(directory):
+                    raise
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.rename(tmp_path, path)
+
+    def get(self, params):
+        """Returns the cached response, or None."""
+        path = self._path(self.key(params))
+        if not os.path.exists(path):
+            return None
+        f = gzip.open(path, 'rb')
+        try:
+            return json.loads(f.read())
+        finally:
+            f.close()
+
+    def put(self, params, data):
+        path = self._path(self.key(params))
+        content = json.dumps(data)
+        # gzip the content in memory, so it can be written atomically
+        buf = StringIO.StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode='wb')
+        f.write(content)
+        f.close()
+        self._write(path, buf.getvalue())
+
+    def get_profile_id(self):
+        path = os.path.join(self.directory, 'profile_id')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return f.read().strip()
+
+    def set_profile_id(self, profile_id):
+        self._write(os.path.join(self.directory, 'profile_id'), profile_id)
+
+
+def to_report_request(params):
+    """Translates the parameters of a Core Reporting API (v3) query into
+    a Reporting API v4 reportRequest."""
+    request = {
+        'viewId': params['ids'].replace('ga:', ''),
+        'dateRanges': [{'startDate': params['start-date'],
+                        'endDate': params['end-date']}],
+        'metrics': [{'expression': metric.strip()}
+                    for metric in params['metrics'].split(',')],
+        'pageSize': int(params.get('max-results', 10000)),
+    }
+    if params.get('dimensions'):
+        request['dimensions'] = [{'name': dimension.strip()}
+                                 for dimension in params['dimensions'].split(',')]
+    if params.get('filters'):
+        # v4 accepts filters in the v3 syntax
+        request['filtersExpression'] = params['filters']
+    if params.get('sort'):
+        request['orderBys'] = [
+            {'fieldName': field.strip().lstrip('-'),
+             'sortOrder': 'DESCENDING' if field.strip().startswith('-') else 'ASCENDING'}
+            for field in params['sort'].split(',')]
+    if int(params.get('start-index', 1)) > 1:
+        request['pageToken'] = str(int(params['start-index']) - 1)
+    return request
+
+
+def from_report(report):
+    """Translates a Reporting API v4 report into the shape of a Core
+    Reporting API (v3) response, i.e. rows of dimension values followed by
+    metric values, so that it can be handled in the same way."""
+    data = report.get('data', {})
+    rows = []
+    for row in data.get('rows', []):
+        values = list(row.get('dimensions', []))
+        for metric in row.get('metrics', [])[:1]:
+            values.extend(metric.get('values', []))
+        rows.append(values)
+    results = {'rows': rows, 'totalResults': data.get('rowCount', len(rows))}
+    if report.get('nextPageToken'):
+        results['nextLink'] = report['nextPageToken']
+    return results
+
+
+def batch_key(params):
+    """Queries can only be batched together if these are the same."""
+    return (params['ids'], params['start-date'], params['end-date'])
+
+
+class GA(object):
+    """
+    Makes requests to the Google Analytics Core Reporting API over one
+    persistent requests.Session, so connections are kept alive and reused
+    between requests (and threads). Responses are gzip compressed.
+
+    Requests that fail with a 429 or 5xx, a rate limit 403, a timeout or a
+    connection error are retried up to `retries` times, waiting
+    `backoff` * 2^n seconds (plus some jitter) before the nth retry. A 401
+    refreshes the token from the token cache and tries again straight away.
+
+    With a ResponseCache every response is stored in it. With replay=True
+    as well, responses come only from the cache and the network is never
+    used.
+
+    batch_get sends up to MAX_BATCH_SIZE queries for the same profile and
+    dates in one request to the Reporting API v4 batchGet endpoint at
+    batch_url, and returns each result as get would.
+
+    With a QuotaScheduler, every request (including retries) waits for its
+    turn within the quotas. A query costs 1 and a batch costs 1 for each
+    query in it.
+    """
+
+    def __init__(self, token_cache, api_url=API_URL, timeout=60, retries=5,
+                 backoff=1.0, pool_size=10, cache=None, replay=False,
+                 batch_url=BATCH_URL, quota=None):
+        self.token_cache = token_cache
+        self.cache = cache
+        self.quota = quota
+        self.replay = replay
+        if replay and cache is None:
+            raise GAError('Replaying needs a response cache')
+        self.api_url = api_url
+        self.batch_url = batch_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Google only compresses responses for user agents that say "gzip"
+        self.session.headers.update({'Accept-Encoding': 'gzip',
+                                     'User-Agent': 'ckanext-ga-report (gzip)'})
+
+    def _should_retry(self, response):
+        if response.status_code in RETRY_STATUSES:
+            return True
+        if response.status_code == 403:
+            try:
+                errors = response.json()['error']['errors']
+            except (ValueError, KeyError, TypeError):
+                return False
+            return any(error.get('reason') in RETRY_REASONS for error in errors)
+        return False
+
+    def _wait(self, attempt):
+        delay = self.backoff * (2 ** attempt) + random.uniform(0, self.backoff)
+        log.info('Retrying the GA request in %.1fs', delay)
+        time.sleep(delay)
+
+    def get(self, params):
+        """Returns the decoded JSON response to a query with the given
+        parameters. Raises GAError if it can't be got."""
+        if self.replay:
+            data = self.cache.get(params)
+            if data is None:
+                raise CacheMiss('No cached response for params %s' % params)
+            return data
+
+        data = self._request('get', self.api_url, params, params=params)
+        if self.cache is not None:
+            self.cache.put(params, data)
+        return data
+
+    def batch_get(self, queries):
+        """
+        Returns the results of a list of queries, in the same order, with
+        as few requests as possible. The queries are grouped by profile and
+        dates and each group is sent MAX_BATCH_SIZE at a time. As with get,
+        the results only come from the cache when replaying.
+        """
+        results = [None] * len(queries)
+        groups = {}
+        for i, params in enumerate(queries):
+            if self.replay:
+                results[i] = self.cache.get(params)
+                if results[i] is None:
+                    raise CacheMiss('No cached response for params %s' % params)
+            else:
+                groups.setdefault(batch_key(params), []).append(i)
+
+        for indexes in groups.itervalues():
+            for start in range(0, len(indexes), MAX_BATCH_SIZE):
+                batch = indexes[start:start + MAX_BATCH_SIZE]
+                body = {'reportRequests': [to_report_request(queries[i])
+                                           for i in batch]}
+                response = self._request('post', self.batch_url, body,
+                                         cost=len(batch),
+                                         data=json.dumps(body),
+                                         extra_headers={'Content-Type': 'application/json'})
+                reports = response.get('reports', [])
+                if len(reports) != len(batch):
+                    raise GAError('Expected %d reports, got %d' % (len(batch), len(reports)))
+                for i, report in zip(batch, reports):
+                    results[i] = from_report(report)
+                    if self.cache is not None:
+                        self.cache.put(queries[i], results[i])
+        return results
+
+    def _request(self, method, url, description, extra_headers=None, cost=1,
+                 **kwargs):
+        attempt = 0
+        refreshed = False
+        while True:
+            if self.quota is not None:
+                self.quota.acquire(cost)
+            headers = {'authorization': 'Bearer ' + self.token_cache.get_token()}
+            headers.update(extra_headers or {})
+            try:
+                response = self.session.request(method, url, headers=headers,
+                                                timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout), e:
+                if attempt >= self.retries:
+                    raise GAError('Request %s failed: %s' % (description, e))
+                log.warning('GA request failed: %s', e)
+                self._wait(attempt)
+                attempt += 1
+                continue
+
+            if response.status_code == 200:
+                return response.json()
+            if response.status_code == 401 and not refreshed:
+                log.info('OAuth token rejected, refreshing it')
+                self.token_cache.invalidate()
+                refreshed = True
+                continue
+            if self._should_retry(response) and attempt < self.retries:
+                log.warning('GA request returned %s', response.status_code)
+                self._wait(attempt)
+                attempt += 1
+                continue
+
+            log.info('STATUS: %s', response.status_code)
+            log.info('CONTENT: %s', response.content)
+            raise GAError('Request %s failed with status %s' % (
+                description, response.status_code))
@@ -1,5 +1,7 @@
 import re
 import uuid
+import datetime
+import collections
 
 from sqlalchemy import Table, Column, MetaData, ForeignKey
 from sqlalchemy import types
@@ -17,24 +19,62 @@ def make_uuid():
 
 metadata = MetaData()
 
+class GA_UrlDim(object):
+    '''A url that has had views, with the dataset and publisher it belongs
+    to. The other url tables refer to it by its integer id.'''
+
+    def __init__(self, **kwargs):
+        for k,v in kwargs.items():
+            setattr(self, k, v)
+
+url_dim_table = Table('ga_url_dim', metadata,
+                      Column('id', types.Integer, primary_key=True),
+                      Column('url', types.UnicodeText, unique=True, nullable=False),
+                      Column('department_id', types.UnicodeText),
+                      Column('package_id', types.UnicodeText),
+                )
+mapper(GA_UrlDim, url_dim_table)
+
+
 class GA_Url(object):
+    '''The views and visits of a url in a period. Mapped onto ga_url joined
+    to ga_url_dim, so the url, department_id and package_id are available
+    as attributes and in queries.'''
 
     def __init__(self, **kwargs):
         for k,v in kwargs.items():
             setattr(self, k, v)
 
 url_table = Table('ga_url', metadata,
-                      Column('id', types.UnicodeText, primary_key=True,
-                             default=make_uuid),
-                      Column('period_name', types.UnicodeText),
+                      Column('period_name', types.UnicodeText, primary_key=True),
+                      Column('url_id', types.Integer, primary_key=True,
+                             autoincrement=False),
                       Column('period_complete_day', types.Integer),
-                      Column('pageviews', types.UnicodeText),
-                      Column('visits', types.UnicodeText),
-                      Column('url', types.UnicodeText),
-                      Column('department_id', types.UnicodeText),
-                      Column('package_id', types.UnicodeText),
+                      Column('pageviews', types.Integer),
+                      Column('visits', types.Integer),
+                )
+mapper(GA_Url, url_table.join(url_dim_table,
+                              url_table.c.url_id==url_dim_table.c.id),
+       properties={'url_id': [url_table.c.url_id, url_dim_table.c.id]})
+
+
+class GA_UrlTotal(object):
+    '''All-time totals for a url, summed over every period in ga_url.
+    Kept up to date incrementally as each period is loaded.'''
+
+    def __init__(self, **kwargs):
+        for k,v in kwargs.items():
+            setattr(self, k, v)
+
+url_total_table = Table('ga_url_all', metadata,
+                        Column('url_id', types.Integer, primary_key=True,
+                               autoincrement=False),
+                        Column('pageviews', types.Integer, default=0),
+                        Column('visits', types.Integer, default=0),
                 )
-mapper(GA_Url, url_table)
+mapper(GA_UrlTotal, url_total_table.join(url_dim_table,
+                                         url_total_table.c.url_id==url_dim_table.c.id),
+       properties={'url_id': [url_total_table.c.url_id, url_dim_table.c.id]})
 
 
 class GA_Stat(object):
@@ -50,7 +90,7 @@ stat_table = Table('ga_stat', metadata,
                   Column('period_complete_day', types.UnicodeText),
                   Column('stat_name', types.UnicodeText),
                   Column('key', types.UnicodeText),
-                  Column('value', types.UnicodeText), )
+                  Column('value', types.Numeric), )
 mapper(GA_Stat, stat_table)
 
 
@@ -65,8 +105,8 @@ pub_table = Table('ga_publisher', metadata,
                          default=make_uuid),
                   Column('period_name', types.UnicodeText),
                   Column('publisher_name', types.UnicodeText),
-                  Column('views', types.UnicodeText),
-                  Column('visits', types.UnicodeText),
+                  Column('views', types.Integer),
+                  Column('visits', types.Integer),
                   Column('toplevel', types.Boolean, default=False),
                   Column('subpublishercount', types.Integer, default=0),
                   Column('parent', types.UnicodeText),
@@ -91,9 +131,448 @@ referrer_table = Table('ga_referrer', metadata,
 mapper(GA_ReferralStat, referrer_table)
 
 
+class GA_Popularity(object):
+    '''The "current popularity" score of a dataset, recalculated for every
+    dataset after each load. See update_popularity_scores.'''
+
+    def __init__(self, **kwargs):
+        for k,v in kwargs.items():
+            setattr(self, k, v)
+
+popularity_table = Table('ga_popularity', metadata,
+                         Column('package_name', types.UnicodeText, primary_key=True),
+                         Column('score', types.Integer, default=0),
+                )
+mapper(GA_Popularity, popularity_table)
+
+
+class GA_LoadCheckpoint(object):
+    '''Records that a complete month has been loaded, so that a backfill
+    that is stopped can carry on where it left off.'''
+
+    def __init__(self, **kwargs):
+        for k,v in kwargs.items():
+            setattr(self, k, v)
+
+checkpoint_table = Table('ga_load_checkpoint', metadata,
+                         Column('period_name', types.UnicodeText, primary_key=True),
+                         Column('loaded', types.DateTime),
+                )
+mapper(GA_LoadCheckpoint, checkpoint_table)
+
+
+class GA_LoadMark(object):
+    '''The last day of a period that has been loaded: the high-water mark
+    that `loadanalytics latest --incremental` carries on from. It is null
+    if the period's data ends part-way through a day.'''
+
+    def __init__(self, **kwargs):
+        for k,v in kwargs.items():
+            setattr(self, k, v)
+
+load_mark_table = Table('ga_load_mark', metadata,
+                        Column('period_name', types.UnicodeText, primary_key=True),
+                        Column('loaded_through', types.Date),
+                )
+mapper(GA_LoadMark, load_mark_table)
+
+
+class GA_ResourceMap(object):
+    '''A key (resource id, url, url path, '.files' path or filename) that
+    downloads of a resource are matched by, and the resource and dataset
+    that it belongs to. Kept up to date by the plugin as datasets are
+    saved; see update_resource_map.'''
+
+    def __init__(self, **kwargs):
+        for k,v in kwargs.items():
+            setattr(self, k, v)
+
+resource_map_table = Table('ga_resource_map', metadata,
+                           Column('kind', types.UnicodeText, primary_key=True),
+                           Column('key', types.UnicodeText, primary_key=True),
+                           Column('resource_id', types.UnicodeText),
+                           Column('package_id', types.UnicodeText),
+                           Column('updated', types.DateTime),
+                )
+mapper(GA_ResourceMap, resource_map_table)
+
+
+# A period is loaded into staging copies of the per-period tables and then
+# moved into the live tables in one transaction by publish_period, so the
+# reports never see a half-loaded period.
+def _staging_table(table):
+    return Table(table.name + '_staging', metadata,
+                 *[column.copy() for column in table.columns])
+
+staging_tables = dict((table.name, _staging_table(table))
+                      for table in (stat_table, pub_table, referrer_table))
+# urls are staged with the url and its dataset and publisher on each row
+staging_tables['ga_url'] = Table('ga_url_staging', metadata,
+                      Column('id', types.UnicodeText, primary_key=True,
+                             default=make_uuid),
+                      Column('period_name', types.UnicodeText),
+                      Column('period_complete_day', types.Integer),
+                      Column('pageviews', types.Integer),
+                      Column('visits', types.Integer),
+                      Column('url', types.UnicodeText),
+                      Column('department_id', types.UnicodeText),
+                      Column('package_id', types.UnicodeText),
+                )
+
+# The rows of ga_url with their url, dataset and publisher, i.e. laid out
+# like the staging table. For use in the FROM clause of raw SQL.
+URL_ROWS = '''(select f.period_name, f.period_complete_day,
+                      f.pageviews, f.visits,
+                      d.url, d.department_id, d.package_id
+                 from ga_url f
+                 join ga_url_dim d on d.id = f.url_id)'''
+
+
+def _table_name(table_name, staging):
+    return table_name + '_staging' if staging else table_name
+
+
+# Indexes for the queries that the loader and the reports run:
+# (index name, table, indexed columns)
+INDEXES = [
+    ('ga_url_url_id_idx', 'ga_url', '(url_id)'),
+    ('ga_url_period_pageviews_idx', 'ga_url', '(period_name, pageviews desc)'),
+    ('ga_url_dim_department_idx', 'ga_url_dim', '(department_id)'),
+    ('ga_url_dim_package_idx', 'ga_url_dim', '(package_id)'),
+    # for the "url like '/data/dataset/%'" filters
+    ('ga_url_dim_url_pattern_idx', 'ga_url_dim', '(url text_pattern_ops)'),
+    ('ga_url_all_pageviews_idx', 'ga_url_all', '(pageviews desc)'),
+    ('ga_url_staging_period_url_idx', 'ga_url_staging', '(period_name, url)'),
+    ('ga_stat_name_period_key_idx', 'ga_stat', '(stat_name, period_name, key)'),
+    ('ga_publisher_period_name_idx', 'ga_publisher', '(period_name, publisher_name)'),
+    ('ga_referrer_period_idx', 'ga_referrer', '(period_name)'),
+    ('ga_popularity_score_idx', 'ga_popularity', '(score desc)'),
+]
+
+# Indexes that earlier versions created and that are no longer wanted,
+# e.g. those on the url columns that moved to ga_url_dim
+OBSOLETE_INDEXES = [
+    'ga_url_period_url_idx',
+    'ga_url_period_department_idx',
+    'ga_url_package_idx',
+    'ga_url_url_pattern_idx',
+    'ga_url_all_department_idx',
+    'ga_url_all_url_pattern_idx',
+]
+
 
 def init_tables():
     metadata.create_all(model.meta.engine)
+    create_indexes()
+
+
+def create_indexes(concurrently=False):
+    '''
+    Creates any of the INDEXES that do not exist yet, and drops any of the
+    OBSOLETE_INDEXES that do. Indexes on tables that don't exist are
+    skipped.
+
+    With concurrently=True they are built with CREATE INDEX CONCURRENTLY,
+    which does not block writes to the table while the index is built. An
+    invalid index left behind by an interrupted concurrent build is dropped
+    and built again.
+    '''
+    from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction, so use a
+    # connection of our own in autocommit mode, and do not return it to the
+    # pool afterwards.
+    connection = model.meta.engine.raw_connection()
+    connection.detach()
+    try:
+        connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = connection.cursor()
+        for index_name in OBSOLETE_INDEXES:
+            cursor.execute("select 1 from pg_class where relname = %s",
+                           (index_name,))
+            if cursor.fetchone():
+                log.info('Dropping obsolete index %s', index_name)
+                cursor.execute('drop index if exists %s' % index_name)
+        for index_name, table_name, columns in INDEXES:
+            cursor.execute("""select i.indisvalid
+                                from pg_index i
+                                join pg_class c on c.oid = i.indexrelid
+                               where c.relname = %s""", (index_name,))
+            row = cursor.fetchone()
+            if row and row[0]:
+                continue
+            if row:
+                log.info('Dropping invalid index %s', index_name)
+                cursor.execute('drop index %s' % index_name)
+            # Indexes on a partitioned table are created on each partition
+            # and cannot be built concurrently.
+            cursor.execute("""select relkind from pg_class
+                               where relname = %s
+                                 and pg_table_is_visible(oid)""", (table_name,))
+            row = cursor.fetchone()
+            if row is None:
+                log.warning('Not creating index %s, as there is no table %s',
+                            index_name, table_name)
+                continue
+            partitioned = row[0] == 'p'
+            log.info('Creating index %s', index_name)
+            cursor.execute('create index %s %s on %s %s' % (
+                'concurrently' if concurrently and not partitioned else '',
+                index_name, table_name, columns))
+    finally:
+        connection.close()
+
+
+# Tables holding data for each period, which can be partitioned by period
+PERIOD_TABLES = ['ga_url', 'ga_stat', 'ga_publisher', 'ga_referrer']
+
+
+def _partition_name(table_name, period_name):
+    '''e.g. ga_url_p2014_07'''
+    return '%s_p%s' % (table_name, re.sub('[^a-z0-9]', '_', period_name.lower()))
+
+
+def _is_partitioned(connection, table_name):
+    return connection.execute("""select relkind from pg_class
+                                  where relname = %s
+                                    and pg_table_is_visible(oid)""",
+                              table_name).scalar() == 'p'
+
+
+def _create_partition(connection, table_name, period_name, parent_name=None):
+    connection.execute(
+        "create table if not exists %s partition of %s for values in (%%s)" % (
+            _partition_name(table_name, period_name), parent_name or table_name),
+        period_name)
+
+
+def partition_tables(table_names=PERIOD_TABLES):
+    '''
+    Converts each of the PERIOD_TABLES (or the given ones) into a table
+    partitioned by period_name (PostgreSQL 11 or later), with one partition
+    per period and a default partition for anything else. Tables that are
+    already partitioned are left alone.
+
+    Once partitioned, the queries for one period only read its partition,
+    and so do the deletes that replace its rows when publish_period
+    reloads it. delete() drops a period's partitions rather than deleting
+    rows. Each table is copied in its own transaction, during which writes to it
+    wait but reads carry on.
+    '''
+    for table_name in table_names:
+        connection = model.Session.connection()
+        if _is_partitioned(connection, table_name):
+            log.debug('%s is already partitioned', table_name)
+            continue
+        log.info('Partitioning %s', table_name)
+        new_table = table_name + '_partitioned'
+        connection.execute('lock table %s in exclusive mode' % table_name)
+        # No column defaults are copied: the tables have none of their own,
+        # and a serial default left by an earlier version would tie the old
+        # table's sequence to the new one, so that the old one can't be
+        # dropped
+        connection.execute('create table %s (like %s) '
+                           'partition by list (period_name)' % (new_table, table_name))
+        # The partition key has to be part of the primary key
+        primary_key = [column.name for column in metadata.tables[table_name].primary_key]
+        if 'period_name' not in primary_key:
+            primary_key.append('period_name')
+        connection.execute('alter table %s add primary key (%s)' % (
+            new_table, ', '.join(primary_key)))
+        connection.execute('create table %s_default partition of %s default' % (
+            table_name, new_table))
+        periods = connection.execute('select distinct period_name from %s '
+                                     'where period_name is not null' % table_name)
+        for period_name, in periods.fetchall():
+            _create_partition(connection, table_name, period_name, new_table)
+        connection.execute('insert into %s select * from %s' % (new_table, table_name))
+        connection.execute('drop table %s' % table_name)
+        connection.execute('alter table %s rename to %s' % (new_table, table_name))
+        model.Session.commit()
+    create_indexes()
+
+
+def ensure_period_partitions(period_name):
+    '''Creates the partitions for a period in any of the PERIOD_TABLES that
+    are partitioned, ready for its data to be loaded.'''
+    connection = model.Session.connection()
+    for table_name in PERIOD_TABLES:
+        if _is_partitioned(connection, table_name):
+            _create_partition(connection, table_name, period_name)
+    model.Session.commit()
+
+
+def _delete_period(connection, table_name, period_name, drop=False):
+    '''Deletes the rows of a period from one of the PERIOD_TABLES. When the
+    table is partitioned its partition is emptied, or dropped altogether
+    with drop=True, instead.'''
+    if not _is_partitioned(connection, table_name):
+        connection.execute('delete from %s where period_name = %%s' % table_name,
+                           period_name)
+        return
+    partition = _partition_name(table_name, period_name)
+    if connection.execute('select to_regclass(%s)', partition).scalar():
+        connection.execute('%s table %s' % ('drop' if drop else 'truncate',
+                                            partition))
+    # anything for this period that went into the default partition
+    connection.execute('delete from %s_default where period_name = %%s' % table_name,
+                       period_name)
+
+
+# Columns that older versions of the extension stored as text:
+# (table, column, SQL type)
+NUMERIC_COLUMNS = [
+    ('ga_url', 'pageviews', 'integer'),
+    ('ga_url', 'visits', 'integer'),
+    ('ga_publisher', 'views', 'integer'),
+    ('ga_publisher', 'visits', 'integer'),
+    ('ga_stat', 'value', 'numeric'),
+]
+
+
+def _column_type(connection, table_name, column_name):
+    return connection.execute("""select data_type
+                                   from information_schema.columns
+                                  where table_name = %s
+                                    and column_name = %s""",
+                              table_name, column_name).scalar()
+
+
+def migrate_numeric_columns(batch_size=10000):
+    '''
+    Converts the columns in NUMERIC_COLUMNS from text to their numeric
+    types in an existing database, in place.
+
+    The values are copied into a new column batch_size rows at a time, with
+    a commit after each batch so that no long-running lock is held. The new
+    column then replaces the old one in a short final transaction, which
+    also picks up any rows written in the meantime. Columns that are
+    already numeric are skipped, so this is safe to run again.
+    '''
+    for table_name, column_name, sql_type in NUMERIC_COLUMNS:
+        connection = model.Session.connection()
+        if _column_type(connection, table_name, column_name) != 'text':
+            log.debug('%s.%s is already numeric', table_name, column_name)
+            continue
+        new_column = column_name + '_numeric'
+        if not _column_type(connection, table_name, new_column):
+            connection.execute('alter table %s add column %s %s' % (
+                table_name, new_column, sql_type))
+            model.Session.commit()
+
+        copy = """update {table} set {new} = nullif(trim({old}), '')::{type}
+                   where id in (select id from {table}
+                                 where {new} is null
+                                   and nullif(trim({old}), '') is not null
+                                 limit %s)""".format(
+            table=table_name, old=column_name, new=new_column, type=sql_type)
+        converted = 0
+        while True:
+            res = model.Session.connection().execute(copy, batch_size)
+            model.Session.commit()
+            converted += res.rowcount
+            log.info('%s.%s: %d rows converted', table_name, column_name,
+                     converted)
+            if res.rowcount < batch_size:
+                break
+
+        connection = model.Session.connection()
+        connection.execute('lock table %s in exclusive mode' % table_name)
+        connection.execute(copy.replace('limit %s', ''))
+        connection.execute('alter table %s drop column %s' % (
+            table_name, column_name))
+        connection.execute('alter table %s rename column %s to %s' % (
+            table_name, new_column, column_name))
+        model.Session.commit()
+        log.info('%s.%s is now %s', table_name, column_name, sql_type)
+
+
+def migrate_url_layout():
+    """
+    Moves an existing database from the old layout, where every ga_url row
+    held its url, dataset and publisher as text, to the ga_url_dim table
+    and integer url ids. The all-time totals are carried across from the
+    old ga_url_all (which also held urls as text) and from any 'All' period
+    rows in ga_url, as the oldest versions kept them, for urls that the old
+    ga_url_all has no row for.
+
+    Each distinct url is stored once in ga_url_dim, with the dataset and
+    publisher of its latest period. The old tables are renamed out of the
+    way, the new ones filled from them and then the old ones dropped, all
+    in one transaction. Does nothing if ga_url is already in the new layout.
+    Run it before metadata.create_all, which would create the tables in the
+    new layout; any it has created already are filled in.
+
+    If the old ga_url was partitioned (see partition_tables), the new one
+    is partitioned too, once it is filled.
+    """
+    connection = model.Session.connection()
+    if _column_type(connection, 'ga_url', 'url') is None:
+        log.debug('ga_url is not in the old layout')
+        return
+    partitioned = _is_partitioned(connection, 'ga_url')
+    # ga_url_all is only in the old layout if it was created by a version
+    # before ga_url_dim
+    old_tables = ['ga_url']
+    if _column_type(connection, 'ga_url_all', 'url') is not None:
+        old_tables.append('ga_url_all')
+
+    connection.execute('lock table %s in exclusive mode' % ', '.join(old_tables))
+    for table_name in old_tables:
+        connection.execute('alter table %s rename to %s_old' % (
+            table_name, table_name))
+        connection.execute('alter index if exists %s_pkey rename to %s_old_pkey' % (
+            table_name, table_name))
+    url_dim_table.create(bind=connection, checkfirst=True)
+    url_table.create(bind=connection)
+    url_total_table.create(bind=connection, checkfirst=True)
+
+    old_urls = 'select url, department_id, package_id, period_name from ga_url_old'
+    old_totals = """select url, pageviews, visits from ga_url_old
+                     where period_name = 'All'"""
+    if 'ga_url_all' in old_tables:
+        old_urls += """
+                 union all
+                select url, department_id, package_id, 'All'
+                  from ga_url_all_old"""
+        old_totals = """select url, pageviews, visits from ga_url_all_old
+                         union all
+                        """ + old_totals + """
+                           and url not in (select url from ga_url_all_old)"""
+    # the urls' latest period wins, and their 'All' rows only if they have
+    # no other
+    res = connection.execute("""
+        insert into ga_url_dim (url, department_id, package_id)
+        select distinct on (url) url, department_id, package_id
+          from (""" + old_urls + """) u
+         where url is not null
+           and not exists (select 1 from ga_url_dim d where d.url = u.url)
+         order by url, period_name = 'All', period_name desc""")
+    log.info('Stored %d urls in ga_url_dim', res.rowcount)
+    connection.execute("""
+        insert into ga_url (period_name, url_id, period_complete_day,
+                            pageviews, visits)
+        select o.period_name, d.id, max(o.period_complete_day),
+               sum(o.pageviews), sum(coalesce(o.visits, 0))
+          from ga_url_old o
+          join ga_url_dim d on d.url = o.url
+         where o.period_name <> 'All'
+         group by o.period_name, d.id""")
+    connection.execute("""
+        insert into ga_url_all (url_id, pageviews, visits)
+        select d.id, sum(o.pageviews), sum(coalesce(o.visits, 0))
+          from (""" + old_totals + """) o
+          join ga_url_dim d on d.url = o.url
+         group by d.id""")
+
+    # Dropping the old ga_url drops its partitions too, which frees their
+    # names for the new ones
+    connection.execute('drop table %s' % ', '.join(
+        table_name + '_old' for table_name in old_tables))
+    model.Session.commit()
+    log.info('ga_url and ga_url_all now refer to ga_url_dim')
+    if partitioned:
+        partition_tables(['ga_url'])
 
 
 cached_tables = {}
@@ -108,6 +587,24 @@ def get_table(name):
     return cached_tables[name]
 
 
+# Maximum number of rows sent in a single multi-row INSERT
+INSERT_BATCH_SIZE = 1000
+
+
+def _bulk_insert(connection, table_name, columns, rows,
+                 batch_size=INSERT_BATCH_SIZE):
+    '''Inserts rows (tuples of values in the order of columns) into
+    table_name using multi-row INSERT statements, so that each batch of
+    rows costs a single round trip to the database.'''
+    placeholder = '(%s)' % ', '.join(['%s'] * len(columns))
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        sql = 'insert into %s (%s) values %s' % (
+            table_name, ', '.join(columns), ', '.join([placeholder] * len(batch)))
+        params = [value for row in batch for value in row]
+        connection.execute(sql, *params)
+
+
 def _normalize_url(url):
     '''Strip off the hostname etc. Do this before storing it.
 
@@ -117,257 +614,630 @@ def _normalize_url(url):
     return url #'/' + '/'.join(url.split('/')[3:])
 
 
-def _get_package_and_publisher(url):
-    # e.g. /dataset/fuel_prices
-    # e.g. /dataset/fuel_prices/resource/e63380d4
-    dataset_match = re.match('/data/dataset/([^/]+)(/.*)?', url)
-    if dataset_match:
-        dataset_ref = dataset_match.groups()[0]
-        dataset = model.Package.get(dataset_ref)
-        if dataset:
-            publisher_groups = dataset.get_groups('organization')
-            if publisher_groups:
-                return dataset_ref,publisher_groups[0].name
-        return dataset_ref, None
-    else:
-        publisher_match = re.match('/organization/([^/]+)(/.*)?', url)
-        if publisher_match:
-            return None, publisher_match.groups()[0]
-    return None, None
-
-def update_sitewide_stats(period_name, stat_name, data, period_complete_day):
-    for k,v in data.iteritems():
-        item = model.Session.query(GA_Stat).\
-            filter(GA_Stat.period_name==period_name).\
-            filter(GA_Stat.key==k).\
-            filter(GA_Stat.stat_name==stat_name).first()
-        if item:
-            item.period_name = period_name
-            item.key = k
-            item.value = v
-            item.period_complete_day = period_complete_day
-            model.Session.add(item)
+DATASET_URL_RE = re.compile('/data/dataset/([^/]+)(/.*)?')
+PUBLISHER_URL_RE = re.compile('/organization/([^/]+)(/.*)?')
+
+
+class PackagePublisherResolver(object):
+    '''
+    Works out the dataset and publisher that a url refers to.
+
+    Build one per run: every package is loaded, along with the name of its
+    owner organization, in a single query and urls are then resolved from
+    memory. Dataset slugs that match no package are collected in
+    `unmatched`.
+    '''
+
+    def __init__(self):
+        self.packages = {}
+        self.unmatched = set()
+        q = model.Session.query(model.Package.id, model.Package.name,
+                                model.Group.name).\
+            outerjoin(model.Group, model.Group.id==model.Package.owner_org)
+        for package_id, package_name, publisher_name in q:
+            self.packages[package_name] = (package_name, publisher_name)
+            self.packages[package_id] = (package_name, publisher_name)
+        log.debug('Loaded %d packages to resolve urls against',
+                  len(self.packages) / 2)
+
+    def resolve(self, url):
+        '''Returns (package name, publisher name) for the url, with None
+        for either that is not known.'''
+        # e.g. /dataset/fuel_prices
+        # e.g. /dataset/fuel_prices/resource/e63380d4
+        dataset_match = DATASET_URL_RE.match(url)
+        if dataset_match:
+            dataset_ref = dataset_match.groups()[0]
+            if dataset_ref in self.packages:
+                return self.packages[dataset_ref]
+            self.unmatched.add(dataset_ref)
+            return dataset_ref, None
         else:
-            # create the row
-            values = {'id': make_uuid(),
-                     'period_name': period_name,
-                     'period_complete_day': period_complete_day,
-                     'key': k,
-                     'value': v,
-                     'stat_name': stat_name
-                     }
-            model.Session.add(GA_Stat(**values))
-        model.Session.commit()
+            publisher_match = PUBLISHER_URL_RE.match(url)
+            if publisher_match:
+                return None, publisher_match.groups()[0]
+        return None, None
 
+    def log_unmatched(self):
+        if self.unmatched:
+            log.info('Could not match %d dataset slugs to packages, e.g. %r',
+                     len(self.unmatched), sorted(self.unmatched)[:10])
+
+
+RESOURCE_DOWNLOAD_RE = re.compile('(?:\/resource\/)(.*)(?:\/download\/)')
+FILES_PATH_RE = re.compile('(.files.*)')
+FILENAME_RE = re.compile('(\w+\.\w+$)')
+
+
+def _url_path(url):
+    '''The url without its scheme, host or trailing slash, lower case.'''
+    return re.sub('^[a-z]+://[^/]*', '', url.strip().lower()).rstrip('/')
+
+
+def _resource_keys(resource_id, url):
+    '''The (kind, key) pairs that a download of the resource at the url
+    can be matched by.'''
+    keys = [('id', resource_id)]
+    if url:
+        keys.append(('url', url.strip().lower()))
+        keys.append(('path', _url_path(url)))
+        for candidate in (url.lower(), url.lower().replace('-', '')):
+            for kind, regex in (('files', FILES_PATH_RE),
+                                ('filename', FILENAME_RE)):
+                match = regex.search(candidate)
+                if match:
+                    keys.append((kind, match.group(1)))
+    return keys
 
-def pre_update_url_stats(period_name):
-    q = model.Session.query(GA_Url).\
-        filter(GA_Url.period_name==period_name)
-    log.debug("Deleting %d '%s' records" % (q.count(), period_name))
-    q.delete()
 
-    q = model.Session.query(GA_Url).\
-        filter(GA_Url.period_name == 'All')
-    log.debug("Deleting %d 'All' records..." % q.count())
-    q.delete()
+def _resource_map_exists():
+    # Only remembered once the table is there, as it may be created by
+    # paster upgradedb while this process is running.
+    if not _resource_map_state.get('exists'):
+        _resource_map_state['exists'] = model.meta.engine.has_table('ga_resource_map')
+    return _resource_map_state['exists']
+
+_resource_map_state = {}
+
+
+def update_resource_map(package):
+    '''
+    Adds the current urls of the package's resources to ga_resource_map,
+    replacing any mapping of the same keys to other resources. The urls
+    that the resources had before stay mapped to them. Called from the
+    plugin as datasets are saved, in the same transaction.
+    '''
+    if not _resource_map_exists():
+        return
+    connection = model.Session.connection()
+    now = datetime.datetime.now()
+    for resource in package.resources:
+        for kind, key in _resource_keys(resource.id, resource.url):
+            connection.execute("""delete from ga_resource_map
+                                   where kind = %s and key = %s""", kind, key)
+            connection.execute("""insert into ga_resource_map
+                                      (kind, key, resource_id, package_id, updated)
+                                  values (%s, %s, %s, %s, %s)""",
+                               kind, key, resource.id, package.id, now)
+
+
+def seed_resource_map():
+    '''
+    Fills ga_resource_map from scratch with the current and past urls of
+    every resource, in one transaction. Where past urls of different
+    resources share a key, the most recent wins, and current urls win
+    over past ones.
+    '''
+    connection = model.Session.connection()
+    res = connection.execute("""
+        select r.id, r.url, g.package_id, 0 as current, r.revision_timestamp
+          from resource_revision r
+          join resource_group g on g.id = r.resource_group_id
+        union all
+        select r.id, r.url, g.package_id, 1 as current, null
+          from resource r
+          join resource_group g on g.id = r.resource_group_id
+         order by current, revision_timestamp""")
+    keys = {}
+    for resource_id, url, package_id, current, timestamp in res:
+        for key in _resource_keys(resource_id, url):
+            keys[key] = (resource_id, package_id)
+
+    now = datetime.datetime.now()
+    connection.execute('delete from ga_resource_map')
+    _bulk_insert(connection, 'ga_resource_map',
+                 ('kind', 'key', 'resource_id', 'package_id', 'updated'),
+                 [(kind, key, resource_id, package_id, now)
+                  for (kind, key), (resource_id, package_id) in keys.iteritems()])
+    model.Session.commit()
+    log.info('Mapped %d resource keys', len(keys))
+
+
+class ResourceAttributionIndex(object):
+    '''
+    Works out the dataset and organization that a downloaded resource url
+    belongs to.
+
+    Build one per run: the keys in ga_resource_map, which the plugin keeps
+    up to date with the current and past urls of every resource, are
+    loaded in a single query, along with the name and organization of
+    every dataset. Urls are then matched from memory by resource id, url,
+    url path, '.files' path and filename, in the same order of precedence
+    as the queries this replaces. Datasets that have been renamed are
+    found under their new name.
+    '''
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_url = {}
+        self.by_path = {}
+        self.by_files_path = {}
+        self.by_filename = {}
+        self._matched = {}
+        indexes = {'id': self.by_id, 'url': self.by_url, 'path': self.by_path,
+                   'files': self.by_files_path, 'filename': self.by_filename}
+
+        connection = model.Session.connection()
+        if not connection.execute('select 1 from ga_resource_map limit 1').scalar():
+            seed_resource_map()
+            connection = model.Session.connection()
+
+        packages = {}
+        q = model.Session.query(model.Package.id, model.Package.name,
+                                model.Group.name).\
+            outerjoin(model.Group, model.Group.id==model.Package.owner_org)
+        for package_id, package_name, org_name in q:
+            packages[package_id] = (package_name, org_name)
+
+        res = connection.execute('select kind, key, package_id from ga_resource_map')
+        for kind, key, package_id in res:
+            if package_id in packages:
+                indexes[kind][key] = packages[package_id]
+        self.urls = self.by_url.items()
+        log.debug('Loaded %d resources to attribute downloads to',
+                  len(self.by_id))
+
+    def _match_url(self, url):
+        # any resource with a url containing this one
+        key = url.strip().lower()
+        if key in self.by_url:
+            return self.by_url[key]
+        if _url_path(key) in self.by_path:
+            return self.by_path[_url_path(key)]
+        if key not in self._matched:
+            self._matched[key] = None
+            if key:
+                for resource_url, entry in self.urls:
+                    if key in resource_url:
+                        self._matched[key] = entry
+                        break
+        return self._matched[key]
+
+    def resolve(self, url):
+        '''Returns (package name, organization name) for the resource url,
+        or None if it matches no resource.'''
+        # new style internal download links
+        download_match = RESOURCE_DOWNLOAD_RE.search(url)
+        if not download_match:
+            return self._match_url(url)
+        entry = self.by_id.get(download_match.group(1))
+        for regex, index in ((FILES_PATH_RE, self.by_files_path),
+                             (FILENAME_RE, self.by_filename)):
+            if entry:
+                break
+            match = regex.search(url)
+            if match:
+                entry = index.get(match.group(1).lower())
+        return entry
+
+def update_sitewide_stats(period_name, stat_name, data, period_complete_day,
+                          staging=False):
+    '''Stores the {key: value} data of one site-wide stat for a period.'''
+    update_sitewide_stats_many(period_name, {stat_name: data},
+                               period_complete_day, staging)
+
+
+def update_sitewide_stats_many(period_name, stats, period_complete_day,
+                               staging=False):
+    '''
+    Stores several site-wide stats for a period at once. stats maps each
+    stat name to its {key: value} data, and each value replaces any stored
+    for the same stat and key.
+
+    Each batch of rows is merged by a single statement that deletes the old
+    values and inserts the new ones, and all of them are written in one
+    transaction. With staging=True they go into the staging table, ready
+    for publish_period.
+    '''
+    rows = []
+    for stat_name, data in stats.iteritems():
+        for k, v in data.iteritems():
+            rows.append((make_uuid(), stat_name, k, v))
+    if not rows:
+        return
+
+    table_name = _table_name('ga_stat', staging)
+    connection = model.Session.connection()
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        batch = rows[start:start + INSERT_BATCH_SIZE]
+        values = ', '.join(['(%s, %s, %s, %s::numeric)'] * len(batch))
+        params = [value for row in batch for value in row]
+        connection.execute("""
+            with data (id, stat_name, key, value) as (values """ + values + """),
+                 removed as (delete from """ + table_name + """ s
+                              using data d
+                              where s.period_name = %s
+                                and s.stat_name = d.stat_name
+                                and s.key = d.key)
+            insert into """ + table_name + """ (id, period_name, period_complete_day,
+                                 stat_name, key, value)
+            select d.id, %s, %s::text, d.stat_name, d.key, d.value
+              from data d""",
+            *(params + [period_name, period_name, period_complete_day]))
+    model.Session.commit()
+
+
+def _subtract_period_from_totals(connection, period_name):
+    """Takes the ga_url rows of a period off the all-time totals, ready
+    for the rows themselves to be deleted or replaced."""
+    connection.execute("""
+        update ga_url_all t
+           set pageviews = t.pageviews - p.pageviews,
+               visits = t.visits - p.visits
+          from (select url_id,
+                       sum(pageviews) as pageviews,
+                       sum(coalesce(visits, 0)) as visits
+                  from ga_url
+                 where period_name = %s
+                 group by url_id) p
+         where t.url_id = p.url_id""", period_name)
+
+
+def _add_period_to_totals(connection, period_name):
+    """Adds the ga_url rows of a period onto the all-time totals."""
+    period = """select url_id,
+                       sum(pageviews) as pageviews,
+                       sum(coalesce(visits, 0)) as visits
+                  from ga_url
+                 where period_name = %s
+                 group by url_id"""
+    connection.execute("""
+        update ga_url_all t
+           set pageviews = t.pageviews + p.pageviews,
+               visits = t.visits + p.visits
+          from (""" + period + """) p
+         where t.url_id = p.url_id""", period_name)
+    connection.execute("""
+        insert into ga_url_all (url_id, pageviews, visits)
+        select p.url_id, p.pageviews, p.visits
+          from (""" + period + """) p
+         where not exists (select 1 from ga_url_all t
+                           where t.url_id = p.url_id)""", period_name)
+
+
+def _store_urls(connection, source, period_name=None):
+    """Adds the urls in the source table (ga_url_staging or a load table)
+    to ga_url_dim, or updates their dataset and publisher if they are
+    already there. Only the rows of period_name are read, if it is given;
+    load tables have no period_name column."""
+    params = []
+    where = ''
+    if period_name is not None:
+        where = 'where period_name = %s'
+        params = [period_name]
+    urls = """select url,
+                     max(department_id) as department_id,
+                     max(package_id) as package_id
+                from """ + source + """
+               """ + where + """
+               group by url"""
+    connection.execute("""
+        update ga_url_dim d
+           set department_id = coalesce(u.department_id, d.department_id),
+               package_id = coalesce(u.package_id, d.package_id)
+          from (""" + urls + """) u
+         where d.url = u.url""", *params)
+    connection.execute("""
+        insert into ga_url_dim (url, department_id, package_id)
+        select u.url, u.department_id, u.package_id
+          from (""" + urls + """) u
+         where not exists (select 1 from ga_url_dim d where d.url = u.url)""",
+                       *params)
+
+
+def pre_update_url_stats(period_name):
+    """
+    Removes the url data for a period before it is loaded again. The
+    period's numbers are taken off the all-time totals in the same
+    transaction, so the totals never include a period twice or go missing.
+    """
+    connection = model.Session.connection()
+    _subtract_period_from_totals(connection, period_name)
+    _delete_period(connection, 'ga_url', period_name)
+    log.debug("Deleted the '%s' records", period_name)
 
-    model.Session.flush()
     model.Session.commit()
     model.repo.commit_and_remove()
     log.debug('...done')
 
-def post_update_url_stats():
+def post_update_url_stats(resolver=None):
 
-    """ Check the distinct url field in ga_url and make sure
-        it has an All record.  If not then create one.
+    """ Rebuilds the all-time totals in ga_url_all from scratch by summing
+        every period in ga_url, and resolves the dataset and publisher of
+        every url in ga_url_dim again.
 
-        After running this then every URL should have an All
-        record regardless of whether the URL has an entry for
-        the month being currently processed.
+        The totals are normally maintained incrementally as each period is
+        loaded, so this is only needed to repair them, or to fill them in
+        for the first time. Everything happens in one transaction, so
+        readers see either the old totals or the new ones.
     """
-    log.debug('Post-processing "All" records...')
-    query = """select url, pageviews::int, visits::int
-               from ga_url
-               where url not in (select url from ga_url where period_name ='All')"""
+    log.debug('Rebuilding the all-time url totals...')
     connection = model.Session.connection()
-    res = connection.execute(query)
-
-    views, visits = {}, {}
-    # url, views, visits
-    for row in res:
-        views[row[0]] = views.get(row[0], 0) + row[1]
-        visits[row[0]] = visits.get(row[0], 0) + row[2]
-
-    progress_total = len(views.keys())
-    progress_count = 0
-    for key in views.keys():
-        progress_count += 1
-        if progress_count % 100 == 0:
-            log.debug('.. %d/%d done so far', progress_count, progress_total)
-
-        package, publisher = _get_package_and_publisher(key)
-
-        values = {'id': make_uuid(),
-                  'period_name': "All",
-                  'period_complete_day': 0,
-                  'url': key,
-                  'pageviews': views[key],
-                  'visits': visits[key],
-                  'department_id': publisher,
-                  'package_id': package
-                  }
-        model.Session.add(GA_Url(**values))
+
+    if resolver is None:
+        resolver = PackagePublisherResolver()
+    rows = []
+    for url_id, url in connection.execute("select id, url from ga_url_dim"):
+        package, publisher = resolver.resolve(url)
+        rows.append((url_id, publisher, package))
+    resolver.log_unmatched()
+    connection.execute("""create temporary table ga_url_resolved (
+                              id integer, department_id text, package_id text
+                          ) on commit drop""")
+    _bulk_insert(connection, 'ga_url_resolved',
+                 ('id', 'department_id', 'package_id'), rows)
+    connection.execute("""
+        update ga_url_dim d
+           set department_id = r.department_id,
+               package_id = r.package_id
+          from ga_url_resolved r
+         where d.id = r.id""")
+
+    connection.execute("delete from ga_url where period_name = 'All'")
+    connection.execute("delete from ga_url_all")
+    connection.execute("""
+        insert into ga_url_all (url_id, pageviews, visits)
+        select url_id, sum(pageviews), sum(coalesce(visits, 0))
+          from ga_url
+         group by url_id""")
     model.Session.commit()
-    log.debug('..done')
+    log.debug('..done (%d urls)', len(rows))
 
 
-def update_url_stats(period_name, period_complete_day, url_data):
-    '''
+def update_url_stats(period_name, period_complete_day, url_data, resolver=None,
+                     staging=False):
+    """
     Given a list of urls and number of hits for each during a given period,
-    stores them in GA_Url under the period and recalculates the totals for
-    the 'All' period.
-    '''
-    progress_total = len(url_data)
-    progress_count = 0
+    stores them in GA_Url under the period and adds them onto the all-time
+    totals in GA_UrlTotal.
+
+    The whole of url_data is written in one transaction: rows for the same
+    url are summed in memory, loaded into a temporary table and then merged
+    into ga_url_dim and ga_url with a handful of set-based statements. Pass
+    in a PackagePublisherResolver to share one between calls.
+
+    With staging=True the rows are merged into the staging table instead,
+    and the totals are left for publish_period to update.
+    """
+    totals = {}
     for url, views, visits in url_data:
-        progress_count += 1
-        if progress_count % 100 == 0:
-            log.debug('.. %d/%d done so far', progress_count, progress_total)
-
-        package, publisher = _get_package_and_publisher(url)
-
-        item = model.Session.query(GA_Url).\
-            filter(GA_Url.period_name==period_name).\
-            filter(GA_Url.url==url).first()
-        if item:
-            item.pageviews = item.pageviews + views
-            item.visits = item.visits + visits
-            if not item.package_id:
-                item.package_id = package
-            if not item.department_id:
-                item.department_id = publisher
-            model.Session.add(item)
-        else:
-            values = {'id': make_uuid(),
-                      'period_name': period_name,
-                      'period_complete_day': period_complete_day,
-                      'url': url,
-                      'pageviews': views,
-                      'visits': visits,
-                      'department_id': publisher,
-                      'package_id': package
-                     }
-            model.Session.add(GA_Url(**values))
+        old_views, old_visits = totals.get(url, (0, 0))
+        totals[url] = (old_views + int(views), old_visits + int(visits or 0))
+    if not totals:
+        return
+
+    if resolver is None:
+        resolver = PackagePublisherResolver()
+    rows = []
+    for url, (views, visits) in totals.iteritems():
+        package, publisher = resolver.resolve(url)
+        rows.append((make_uuid(), url, views, visits, publisher, package))
+    log.debug('Merging %d urls into period %s', len(rows), period_name)
+
+    connection = model.Session.connection()
+    connection.execute("""create temporary table ga_url_load (
+                              id text, url text,
+                              pageviews integer, visits integer,
+                              department_id text, package_id text
+                          ) on commit drop""")
+    _bulk_insert(connection, 'ga_url_load',
+                 ('id', 'url', 'pageviews', 'visits',
+                  'department_id', 'package_id'),
+                 rows)
+
+    if staging:
+        # Add to any rows already staged for this period...
+        connection.execute("""
+            update ga_url_staging u
+               set pageviews = coalesce(u.pageviews, 0) + l.pageviews,
+                   visits = coalesce(u.visits, 0) + l.visits,
+                   package_id = coalesce(nullif(u.package_id, ''), l.package_id),
+                   department_id = coalesce(nullif(u.department_id, ''), l.department_id)
+              from ga_url_load l
+             where u.period_name = %s
+               and u.url = l.url""", period_name)
+        # ...and stage the ones that are new.
+        connection.execute("""
+            insert into ga_url_staging (id, period_name, period_complete_day,
+                                url, pageviews, visits, department_id, package_id)
+            select l.id, %s, %s, l.url, l.pageviews, l.visits,
+                   l.department_id, l.package_id
+              from ga_url_load l
+             where not exists (select 1 from ga_url_staging u
+                               where u.period_name = %s and u.url = l.url)""",
+                           period_name, period_complete_day, period_name)
         model.Session.commit()
+        return
+
+    connection.execute('select pg_advisory_xact_lock(%s)', PUBLISH_LOCK)
+    _store_urls(connection, 'ga_url_load')
+    loaded = """select d.id as url_id, l.pageviews, l.visits
+                  from ga_url_load l
+                  join ga_url_dim d on d.url = l.url"""
+    # Add to any rows already stored for this period...
+    connection.execute("""
+        update ga_url f
+           set pageviews = coalesce(f.pageviews, 0) + l.pageviews,
+               visits = coalesce(f.visits, 0) + l.visits
+          from (""" + loaded + """) l
+         where f.period_name = %s
+           and f.url_id = l.url_id""", period_name)
+    # ...and create the ones that are new.
+    connection.execute("""
+        insert into ga_url (period_name, url_id, period_complete_day,
+                            pageviews, visits)
+        select %s, l.url_id, %s, l.pageviews, l.visits
+          from (""" + loaded + """) l
+         where not exists (select 1 from ga_url f
+                           where f.period_name = %s and f.url_id = l.url_id)""",
+                       period_name, period_complete_day, period_name)
+
+    # Add the same numbers onto the all-time totals.
+    connection.execute("""
+        update ga_url_all t
+           set pageviews = t.pageviews + l.pageviews,
+               visits = t.visits + l.visits
+          from (""" + loaded + """) l
+         where t.url_id = l.url_id""")
+    connection.execute("""
+        insert into ga_url_all (url_id, pageviews, visits)
+        select l.url_id, l.pageviews, l.visits
+          from (""" + loaded + """) l
+         where not exists (select 1 from ga_url_all t
+                           where t.url_id = l.url_id)""")
 
-        if package:
-            old_pageviews, old_visits = 0, 0
-            old = model.Session.query(GA_Url).\
-                filter(GA_Url.period_name=='All').\
-                filter(GA_Url.url==url).all()
-            old_pageviews = sum([int(o.pageviews) for o in old])
-            old_visits = sum([int(o.visits) for o in old])
-
-            entries = model.Session.query(GA_Url).\
-                filter(GA_Url.period_name!='All').\
-                filter(GA_Url.url==url).all()
-            values = {'id': make_uuid(),
-                      'period_name': 'All',
-                      'period_complete_day': 0,
-                      'url': url,
-                      'pageviews': sum([int(e.pageviews) for e in entries]) + int(old_pageviews),
-                      'visits': sum([int(e.visits or 0) for e in entries]) + int(old_visits),
-                      'department_id': publisher,
-                      'package_id': package
-                     }
-
-            model.Session.add(GA_Url(**values))
-            model.Session.commit()
+    model.Session.commit()
 
 
+def update_social(period_name, data, staging=False):
+    '''
+    Replaces the referral stats for a period. data maps each url to a list
+    of (source, count) pairs; counts for the same url and source are added
+    together and the period is written in one transaction, to the staging
+    table with staging=True.
+    '''
+    counts = collections.defaultdict(int)
+    for url, entries in data.iteritems():
+        for source, count in entries:
+            counts[(url, source)] += count
 
+    rows = [(make_uuid(), period_name, source, url, count)
+            for (url, source), count in counts.iteritems()]
 
-def update_social(period_name, data):
+    table_name = _table_name('ga_referrer', staging)
+    connection = model.Session.connection()
     # Clean up first.
-    model.Session.query(GA_ReferralStat).\
-        filter(GA_ReferralStat.period_name==period_name).delete()
-
-    for url,data in data.iteritems():
-        for entry in data:
-            source = entry[0]
-            count = entry[1]
-
-            item = model.Session.query(GA_ReferralStat).\
-                filter(GA_ReferralStat.period_name==period_name).\
-                filter(GA_ReferralStat.source==source).\
-                filter(GA_ReferralStat.url==url).first()
-            if item:
-                item.count = item.count + count
-                model.Session.add(item)
-            else:
-                # create the row
-                values = {'id': make_uuid(),
-                          'period_name': period_name,
-                          'source': source,
-                          'url': url,
-                          'count': count,
-                         }
-                model.Session.add(GA_ReferralStat(**values))
-            model.Session.commit()
+    connection.execute("delete from %s where period_name = %%s" % table_name,
+                       period_name)
+    _bulk_insert(connection, table_name,
+                 ('id', 'period_name', 'source', 'url', 'count'),
+                 rows)
+    model.Session.commit()
 
-def update_publisher_stats(period_name):
+def _publisher_descendants(children, names):
+    '''
+    Returns the set of publishers anywhere beneath each of the names, given
+    the children of each publisher.
+
+    A loop in the hierarchy is cut where it comes back to a publisher that
+    is already being expanded. A result that a cut left short (because it
+    depends on where the traversal started) isn't remembered, so each
+    publisher gets all of the publishers reachable from it, apart from
+    itself.
+    '''
+    # The publishers reachable from each one, including itself if it is in
+    # a loop
+    reachable = {}
+
+    def get_reachable(name, path):
+        # Returns the publishers found, and the publishers in path that
+        # were cut off
+        if name in reachable:
+            return reachable[name], set()
+        found, cut = set(), set()
+        for child in children[name]:
+            if child in path:
+                cut.add(child)
+                continue
+            found.add(child)
+            if child != name:
+                child_found, child_cut = get_reachable(child, path + (name,))
+                found.update(child_found)
+                cut.update(child_cut)
+        if name in cut:
+            # a loop back to this publisher, which found is complete without
+            cut.discard(name)
+            found.add(name)
+        if not cut:
+            reachable[name] = found
+        return found, cut
+
+    return dict((name, get_reachable(name, ())[0] - set([name]))
+                for name in names)
+
+
+def update_publisher_stats(period_name, staging=False):
     """
     Updates the publisher stats from the data retrieved for /dataset/*
-    and /publisher/*. Will run against each dataset and generates the
-    totals for the entire tree beneath each publisher.
+    and /publisher/*. Generates the totals for the entire tree beneath
+    each publisher.
+
+    The organizations, the links between them and the period's views and
+    visits per publisher are each read with a single query. The subtree
+    totals are then added up from an in-memory parent/child map and the
+    period's GA_Publisher rows are replaced in bulk. With staging=True the
+    url data is read from, and the rows written to, the staging tables.
     """
-    toplevel = get_top_level()
-    publishers = model.Session.query(model.Group).\
-        filter(model.Group.type=='organization').\
-        filter(model.Group.state=='active').all()
-    for publisher in publishers:
-        views, visits, subpub = update_publisher(period_name, publisher, publisher.name)
-        parent, parents = '', publisher.get_parent_groups(type='organization')
-        if parents:
-            parent = parents[0].name
-        item = model.Session.query(GA_Publisher).\
-            filter(GA_Publisher.period_name==period_name).\
-            filter(GA_Publisher.publisher_name==publisher.name).first()
-        if item:
-            item.views = views
-            item.visits = visits
-            item.publisher_name = publisher.name
-            item.toplevel = publisher in toplevel
-            item.subpublishercount = subpub
-            item.parent = parent
-            model.Session.add(item)
-        else:
-            # create the row
-            values = {'id': make_uuid(),
-                     'period_name': period_name,
-                     'publisher_name': publisher.name,
-                     'views': views,
-                     'visits': visits,
-                     'toplevel': publisher in toplevel,
-                     'subpublishercount': subpub,
-                     'parent': parent
-                     }
-            model.Session.add(GA_Publisher(**values))
-        model.Session.commit()
-
+    _store_publisher_stats(model.Session.connection(), period_name, staging)
+    model.Session.commit()
 
-def update_publisher(period_name, pub, part=''):
-    views,visits,subpub = 0, 0, 0
-    for publisher in go_down_tree(pub):
-        subpub = subpub + 1
-        items = model.Session.query(GA_Url).\
-                filter(GA_Url.period_name==period_name).\
-                filter(GA_Url.department_id==publisher.name).all()
-        for item in items:
-            views = views + int(item.pageviews)
-            visits = visits + int(item.visits)
 
-    return views, visits, (subpub-1)
+def _store_publisher_stats(connection, period_name, staging=False):
+    """The work of update_publisher_stats, in the caller's transaction."""
+    names = dict(model.Session.query(model.Group.id, model.Group.name).\
+        filter(model.Group.type=='organization').\
+        filter(model.Group.state=='active'))
+
+    children = collections.defaultdict(list)
+    parents = {}
+    links = model.Session.query(model.Member.table_id, model.Member.group_id).\
+        filter(model.Member.table_name=='group').\
+        filter(model.Member.state=='active')
+    for child_id, parent_id in links:
+        if child_id in names and parent_id in names:
+            children[names[parent_id]].append(names[child_id])
+            parents.setdefault(names[child_id], names[parent_id])
+
+    totals = {}
+    res = connection.execute("""select department_id,
+                                       sum(pageviews), sum(coalesce(visits, 0))
+                                  from %s u
+                                 where period_name = %%s
+                                 group by department_id""" % (
+        'ga_url_staging' if staging else URL_ROWS), period_name)
+    for publisher_name, views, visits in res:
+        totals[publisher_name] = (views, visits)
+
+    descendants = _publisher_descendants(children, names.itervalues())
+    rows = []
+    for publisher_name in names.itervalues():
+        subtree = descendants[publisher_name]
+        views, visits = 0, 0
+        for name in subtree | set([publisher_name]):
+            views += totals.get(name, (0, 0))[0]
+            visits += totals.get(name, (0, 0))[1]
+        rows.append((make_uuid(), period_name, publisher_name, views, visits,
+                     publisher_name not in parents, len(subtree),
+                     parents.get(publisher_name, '')))
+
+    table_name = _table_name('ga_publisher', staging)
+    connection.execute("delete from %s where period_name = %%s" % table_name,
+                       period_name)
+    _bulk_insert(connection, table_name,
+                 ('id', 'period_name', 'publisher_name', 'views', 'visits',
+                  'toplevel', 'subpublishercount', 'parent'),
+                 rows)
+    log.debug('Stored stats for %d publishers', len(rows))
 
 
 def get_top_level():
@@ -392,45 +1262,319 @@ def go_down_tree(publisher):
         for grandchild in go_down_tree(child):
             yield grandchild
 
+def _clear_staging(period_name):
+    connection = model.Session.connection()
+    for table in staging_tables.itervalues():
+        connection.execute('delete from %s where period_name = %%s' % table.name,
+                           period_name)
+    model.Session.commit()
+
+
+def start_staging(period_name):
+    """Empties the staging tables of any data for the period, ready for it
+    to be loaded."""
+    metadata.create_all(model.meta.engine, tables=staging_tables.values())
+    _clear_staging(period_name)
+
+
+def discard_staging(period_name):
+    """Throws away the data staged for the period, when its load has
+    failed. The live data for the period is untouched."""
+    model.Session.rollback()
+    _clear_staging(period_name)
+
+
+def _copy_from_staging(connection, table_name, period_name):
+    columns = ', '.join(column.name for column in metadata.tables[table_name].columns)
+    connection.execute("""insert into %s (%s)
+                          select %s from %s_staging
+                           where period_name = %%s""" % (
+        table_name, columns, columns, table_name), period_name)
+
+
+# Key of the advisory lock taken while a period is published
+PUBLISH_LOCK = 5240001
+
+
+# Stats that can't be added up day by day, so are always fetched for the
+# whole period and replace what is there.
+NON_ADDITIVE_STATS = ('Totals',)
+
+
+def _add_from_staging(connection, period_name, period_complete_day, url_stats):
+    """Adds the staged rows for some more days of a period onto the period's
+    live rows. See publish_period."""
+    if url_stats:
+        _store_urls(connection, 'ga_url_staging', period_name)
+        staged = """select d.id as url_id,
+                           sum(s.pageviews) as pageviews,
+                           sum(coalesce(s.visits, 0)) as visits
+                      from ga_url_staging s
+                      join ga_url_dim d on d.url = s.url
+                     where s.period_name = %s
+                     group by d.id"""
+        connection.execute("""
+            update ga_url f
+               set pageviews = coalesce(f.pageviews, 0) + s.pageviews,
+                   visits = coalesce(f.visits, 0) + s.visits
+              from (""" + staged + """) s
+             where f.period_name = %s
+               and f.url_id = s.url_id""", period_name, period_name)
+        connection.execute("""
+            insert into ga_url (period_name, url_id, period_complete_day,
+                                pageviews, visits)
+            select %s, s.url_id, %s, s.pageviews, s.visits
+              from (""" + staged + """) s
+             where not exists (select 1 from ga_url f
+                               where f.period_name = %s and f.url_id = s.url_id)""",
+                           period_name, period_complete_day, period_name, period_name)
+        connection.execute("""
+            update ga_url_all t
+               set pageviews = t.pageviews + s.pageviews,
+                   visits = t.visits + s.visits
+              from (""" + staged + """) s
+             where t.url_id = s.url_id""", period_name)
+        connection.execute("""
+            insert into ga_url_all (url_id, pageviews, visits)
+            select s.url_id, s.pageviews, s.visits
+              from (""" + staged + """) s
+             where not exists (select 1 from ga_url_all t
+                               where t.url_id = s.url_id)""", period_name)
+        connection.execute("""update ga_url set period_complete_day = %s
+                               where period_name = %s""",
+                           period_complete_day, period_name)
+
+    connection.execute("""delete from ga_stat
+                           where period_name = %s
+                             and stat_name in (select stat_name
+                                                 from ga_stat_staging
+                                                where period_name = %s
+                                                  and stat_name in %s)""",
+                       period_name, period_name, NON_ADDITIVE_STATS)
+    connection.execute("""
+        update ga_stat g
+           set value = g.value + s.value
+          from ga_stat_staging s
+         where s.period_name = %s
+           and g.period_name = s.period_name
+           and g.stat_name = s.stat_name
+           and g.key = s.key""", period_name)
+    connection.execute("""
+        insert into ga_stat (id, period_name, period_complete_day,
+                             stat_name, key, value)
+        select s.id, s.period_name, s.period_complete_day,
+               s.stat_name, s.key, s.value
+          from ga_stat_staging s
+         where s.period_name = %s
+           and not exists (select 1 from ga_stat g
+                           where g.period_name = s.period_name
+                             and g.stat_name = s.stat_name
+                             and g.key = s.key)""", period_name)
+    connection.execute("""update ga_stat set period_complete_day = %s
+                           where period_name = %s""",
+                       period_complete_day, period_name)
+
+    connection.execute("""
+        update ga_referrer r
+           set count = r.count + s.count
+          from ga_referrer_staging s
+         where s.period_name = %s
+           and r.period_name = s.period_name
+           and r.source = s.source
+           and r.url = s.url""", period_name)
+    connection.execute("""
+        insert into ga_referrer (id, period_name, source, url, count)
+        select s.id, s.period_name, s.source, s.url, s.count
+          from ga_referrer_staging s
+         where s.period_name = %s
+           and not exists (select 1 from ga_referrer r
+                           where r.period_name = s.period_name
+                             and r.source = s.source
+                             and r.url = s.url)""", period_name)
+
+
+def get_load_mark(last_period=None):
+    """Returns (period_name, loaded_through date) for the latest period
+    that has been loaded, or the latest up to and including last_period,
+    or None. loaded_through is None if the period's data ends part-way
+    through a day."""
+    q = model.Session.query(GA_LoadMark)
+    if last_period is not None:
+        q = q.filter(GA_LoadMark.period_name <= last_period)
+    mark = q.order_by(GA_LoadMark.period_name.desc()).first()
+    if mark:
+        return mark.period_name, mark.loaded_through
+    return None
+
+
+def publish_period(period_name, url_stats=True, replace_all=False,
+                   additive=False, period_complete_day=None,
+                   loaded_through=None):
+    """
+    Moves a period from the staging tables into the live tables in a single
+    transaction, so that readers never wait for a load or see a partial
+    month: they see either the old data for the period or the new.
+
+    The staged stats replace the live stats with the same names and the
+    staged referrers replace the live ones. With url_stats the url and
+    publisher data is replaced as well and the all-time totals adjusted.
+    With replace_all everything stored for the period is replaced.
+
+    With additive=True the staged data is for some more days of the period,
+    so it is added onto the live data instead (apart from the
+    NON_ADDITIVE_STATS, which replace it) and period_complete_day is
+    updated. The publisher stats are then recalculated from the urls, in
+    the same transaction.
+
+    loaded_through, a date, is recorded as the period's high-water mark:
+    the last day that is loaded in full. Without it the mark is recorded
+    without a date, as the live data no longer ends at the end of a day.
+    """
+    connection = model.Session.connection()
+    # Periods loaded in parallel are published one at a time, as they
+    # share the urls and the totals.
+    connection.execute('select pg_advisory_xact_lock(%s)', PUBLISH_LOCK)
+
+    connection.execute('delete from ga_load_mark where period_name = %s',
+                       period_name)
+    connection.execute('insert into ga_load_mark (period_name, loaded_through) '
+                       'values (%s, %s)', period_name, loaded_through)
+
+    if additive:
+        _add_from_staging(connection, period_name, period_complete_day, url_stats)
+        if url_stats:
+            _store_publisher_stats(connection, period_name)
+        for table in staging_tables.itervalues():
+            connection.execute('delete from %s where period_name = %%s' % table.name,
+                               period_name)
+        model.Session.commit()
+        log.debug('Added to period %s', period_name)
+        return
+
+    if url_stats or replace_all:
+        _subtract_period_from_totals(connection, period_name)
+        for table_name in ('ga_url', 'ga_publisher'):
+            connection.execute('delete from %s where period_name = %%s' % table_name,
+                               period_name)
+    if url_stats:
+        _store_urls(connection, 'ga_url_staging', period_name)
+        connection.execute("""
+            insert into ga_url (period_name, url_id, period_complete_day,
+                                pageviews, visits)
+            select s.period_name, d.id, s.period_complete_day,
+                   s.pageviews, s.visits
+              from ga_url_staging s
+              join ga_url_dim d on d.url = s.url
+             where s.period_name = %s""", period_name)
+        _copy_from_staging(connection, 'ga_publisher', period_name)
+        _add_period_to_totals(connection, period_name)
+
+    if replace_all:
+        connection.execute('delete from ga_stat where period_name = %s',
+                           period_name)
+    else:
+        connection.execute("""delete from ga_stat
+                               where period_name = %s
+                                 and stat_name in (select stat_name
+                                                     from ga_stat_staging
+                                                    where period_name = %s)""",
+                           period_name, period_name)
+    _copy_from_staging(connection, 'ga_stat', period_name)
+
+    connection.execute('delete from ga_referrer where period_name = %s',
+                       period_name)
+    _copy_from_staging(connection, 'ga_referrer', period_name)
+
+    for table in staging_tables.itervalues():
+        connection.execute('delete from %s where period_name = %%s' % table.name,
+                           period_name)
+    model.Session.commit()
+    log.debug('Published period %s', period_name)
+
+
 def delete(period_name):
     '''
     Deletes table data for the specified period, or specify 'all'
-    for all periods.
+    for all periods. On partitioned tables the period's partitions are
+    dropped. The period's checkpoint and load mark go too, so that it is
+    loaded again.
     '''
-    for object_type in (GA_Url, GA_Stat, GA_Publisher, GA_ReferralStat):
-        q = model.Session.query(object_type)
-        if period_name != 'All':
-            q = q.filter_by(period_name=period_name)
-        q.delete()
+    connection = model.Session.connection()
+    if period_name != 'All':
+        _subtract_period_from_totals(connection, period_name)
+        for table_name in PERIOD_TABLES:
+            _delete_period(connection, table_name, period_name, drop=True)
+        for table in (checkpoint_table, load_mark_table):
+            connection.execute(table.delete().where(
+                table.c.period_name == period_name))
+    else:
+        # GA_Url and GA_UrlTotal are mapped onto joins, which the ORM can't
+        # bulk delete from, so clear the tables directly. The urls in
+        # ga_url_dim are kept.
+        for table in (url_total_table, url_table, stat_table, pub_table,
+                      referrer_table, checkpoint_table, load_mark_table):
+            connection.execute(table.delete())
     model.repo.commit_and_remove()
 
+def get_loaded_periods():
+    '''Returns the names of the periods that have been checkpointed.'''
+    return set(period_name for (period_name,) in
+               model.Session.query(GA_LoadCheckpoint.period_name))
+
+
+def checkpoint_period(period_name):
+    '''Records that a complete period has been loaded.'''
+    connection = model.Session.connection()
+    connection.execute('delete from ga_load_checkpoint where period_name = %s',
+                       period_name)
+    connection.execute('insert into ga_load_checkpoint (period_name, loaded) '
+                       'values (%s, %s)', period_name, datetime.datetime.now())
+    model.Session.commit()
+
+
+def update_popularity_scores(now=None):
+    '''
+    Recalculates the "current popularity" score of every dataset, based on
+    how many views it has had recently, and stores them in ga_popularity.
+
+    The score is the views per day in the current month plus half of the
+    views per day in the previous month, times 100. Views per day are over
+    the days that the period covers, which for a complete month is the
+    whole month. All the scores come from a single SQL aggregate and
+    replace the old ones in one transaction.
+    '''
+    now = now or datetime.datetime.now()
+    last_month = datetime.date(now.year, now.month, 1) - datetime.timedelta(days=1)
+    this_period = '%s-%02d' % (now.year, now.month)
+    last_period = '%s-%02d' % (last_month.year, last_month.month)
+
+    connection = model.Session.connection()
+    connection.execute("delete from ga_popularity")
+    res = connection.execute("""
+        insert into ga_popularity (package_name, score)
+        select package_id, floor(100 * sum(weight * pageviews / days))::int
+          from (select package_id,
+                       pageviews::float as pageviews,
+                       case when period_name = %%s then 1.0 else 0.5 end as weight,
+                       coalesce(nullif(period_complete_day, 0),
+                                extract(day from to_date(period_name, 'YYYY-MM')
+                                        + interval '1 month' - interval '1 day')
+                                ) as days
+                  from %s u
+                 where period_name in (%%s, %%s)
+                   and package_id <> '') u
+         group by package_id""" % URL_ROWS,
+                             this_period, this_period, last_period)
+    model.Session.commit()
+    log.debug('Updated the popularity of %d datasets', res.rowcount)
+
+
 def get_score_for_dataset(dataset_name):
     '''
     Returns a "current popularity" score for a dataset,
     based on how many views it has had recently.
     '''
-    import datetime
-    now = datetime.datetime.now()
-    last_month = now - datetime.timedelta(days=30)
-    period_names = ['%s-%02d' % (last_month.year, last_month.month),
-                    '%s-%02d' % (now.year, now.month),
-                    ]
-
-    score = 0
-    for period_name in period_names:
-        score /= 2 # previous periods are discounted by 50%
-        entry = model.Session.query(GA_Url)\
-                .filter(GA_Url.period_name==period_name)\
-                .filter(GA_Url.package_id==dataset_name).first()
-        # score
-        if entry:
-            views = float(entry.pageviews)
-            if entry.period_complete_day:
-                views_per_day = views / entry.period_complete_day
-            else:
-                views_per_day = views / 15 # guess
-            score += views_per_day
-
-    score = int(score * 100)
+    score = model.Session.query(GA_Popularity.score).\
+        filter(GA_Popularity.package_name==dataset_name).scalar()
     log.debug('Popularity %s: %s', score, dataset_name)
-    return score
+    return score or 0
@@ -5,7 +5,7 @@ import ckan.lib.base as base
 import ckan.model as model
 from ckan.logic import get_action
 
-from ckanext.ga_report.ga_model import GA_Url, GA_Publisher
+from ckanext.ga_report.ga_model import GA_Url, GA_UrlTotal, GA_Publisher
 from ckanext.ga_report.controller import _get_publishers
 _log = logging.getLogger(__name__)
 
@@ -36,9 +36,9 @@ def single_popular_dataset(top=20):
     '''
     import random
 
-    top_datasets = model.Session.query(GA_Url).\
-                   filter(GA_Url.url.like('/data/dataset/%')).\
-                   order_by('ga_url.pageviews::int desc')
+    top_datasets = model.Session.query(GA_UrlTotal).\
+                   filter(GA_UrlTotal.url.like('/data/dataset/%')).\
+                   order_by(GA_UrlTotal.pageviews.desc())
     num_top_datasets = top_datasets.count()
 
     dataset = None
@@ -100,10 +100,10 @@ def most_popular_datasets(publisher, count=20, preview_image=None):
 
 def _datasets_for_publisher(publisher, count):
     datasets = {}
-    entries = model.Session.query(GA_Url).\
-        filter(GA_Url.department_id==publisher.name).\
-        filter(GA_Url.url.like('/data/dataset/%')).\
-        order_by('ga_url.pageviews::int desc').all()
+    entries = model.Session.query(GA_UrlTotal).\
+        filter(GA_UrlTotal.department_id==publisher.name).\
+        filter(GA_UrlTotal.url.like('/data/dataset/%')).\
+        order_by(GA_UrlTotal.pageviews.desc()).all()
     for entry in entries:
         if len(datasets) < count:
             p = model.Package.get(entry.url[len('/data/dataset/'):])
@@ -123,8 +123,8 @@ def _datasets_for_publisher(publisher, count):
             if not p in datasets:
                 datasets[p] = {'views':0, 'visits': 0}
 
-            datasets[p]['views'] = datasets[p]['views'] + int(entry.pageviews)
-            datasets[p]['visits'] = datasets[p]['visits'] + int(entry.visits)
+            datasets[p]['views'] = datasets[p]['views'] + entry.pageviews
+            datasets[p]['visits'] = datasets[p]['visits'] + entry.visits
 
     results = []
     for k, v in datasets.iteritems():
@@ -1,12 +1,14 @@
 import logging
 import ckan.lib.helpers as h
 import ckan.plugins as p
+import ckan.model as model
 from ckan.plugins import implements, toolkit
 
 from ckanext.ga_report.helpers import (most_popular_datasets,
                                        popular_datasets,
                                        single_popular_dataset,
                                        month_option_title)
+from ckanext.ga_report import ga_model
 
 log = logging.getLogger('ckanext.ga-report')
 
@@ -14,6 +16,7 @@ class GAReportPlugin(p.SingletonPlugin):
     implements(p.IConfigurer, inherit=True)
     implements(p.IRoutes, inherit=True)
     implements(p.ITemplateHelpers, inherit=True)
+    implements(p.IPackageController, inherit=True)
 
     def update_config(self, config):
         toolkit.add_template_directory(config, 'templates')
@@ -32,6 +35,19 @@ class GAReportPlugin(p.SingletonPlugin):
             'month_option_title': month_option_title
         }
 
+    # Resources are created and edited through package_create and
+    # package_update, so these also catch every change to a resource url.
+    def after_create(self, context, pkg_dict):
+        self._update_resource_map(pkg_dict)
+
+    def after_update(self, context, pkg_dict):
+        self._update_resource_map(pkg_dict)
+
+    def _update_resource_map(self, pkg_dict):
+        package = model.Package.get(pkg_dict.get('id') or pkg_dict.get('name'))
+        if package:
+            ga_model.update_resource_map(package)
+
     def after_map(self, map):
         # GaReport
         map.connect(
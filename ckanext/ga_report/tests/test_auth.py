@@ -1,6 +1,7 @@
 import os
+import datetime
 from nose.tools import assert_equal
-from ckanext.ga_report.ga_auth import (init_service, get_profile_id)
+from ckanext.ga_report.ga_auth import (init_service, get_profile_id, TokenCache)
 
 class TestAuth:
 
@@ -38,4 +39,40 @@ class TestAuth:
     def test_get_profile(self):
         svc = init_service("token.dat", "credentials.json")
         profile = get_profile_id(svc)
-        assert profile is not None, "Unable to find a profile given configured UA id and user details"
\ No newline at end of file
+        assert profile is not None, "Unable to find a profile given configured UA id and user details"
+
+class FakeCredentials(object):
+    def __init__(self, expires_in):
+        self.access_token = 'token-0'
+        self.token_expiry = datetime.datetime.utcnow() + \
+            datetime.timedelta(seconds=expires_in)
+        self.refreshes = 0
+
+    def refresh(self, http):
+        self.refreshes += 1
+        self.access_token = 'token-%d' % self.refreshes
+        self.token_expiry = datetime.datetime.utcnow() + \
+            datetime.timedelta(seconds=3600)
+
+
+class TestTokenCache:
+
+    def test_reuses_token(self):
+        cache = TokenCache('token.dat')
+        cache.credentials = FakeCredentials(3600)
+        assert_equal(cache.get_token(), 'token-0')
+        assert_equal(cache.get_token(), 'token-0')
+        assert_equal(cache.credentials.refreshes, 0)
+
+    def test_refreshes_before_expiry(self):
+        cache = TokenCache('token.dat', margin=300)
+        cache.credentials = FakeCredentials(60)
+        assert_equal(cache.get_token(), 'token-1')
+        assert_equal(cache.get_token(), 'token-1')
+        assert_equal(cache.credentials.refreshes, 1)
+
+    def test_invalidate(self):
+        cache = TokenCache('token.dat')
+        cache.credentials = FakeCredentials(3600)
+        cache.invalidate()
+        assert_equal(cache.get_token(), 'token-1')
@@ -0,0 +1,194 @@
+import shutil
+import calendar
+import datetime
+import tempfile
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.ga_report.ga_client import (GA, ResponseCache, QuotaScheduler, QuotaExceeded,
+                                         CacheMiss, pacific_date, to_report_request,
+                                         from_report)
+
+class TestResponseCache:
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ResponseCache(self.directory)
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_key_is_canonical(self):
+        assert_equal(ResponseCache.key({'start-index': 1, 'ids': 'ga:1'}),
+                     ResponseCache.key({'ids': u'ga:1', 'start-index': '1'}))
+        assert ResponseCache.key({'start-index': 1}) != \
+            ResponseCache.key({'start-index': 2})
+
+    def test_put_and_get(self):
+        params = {'ids': 'ga:1', 'metrics': 'ga:pageviews'}
+        assert_equal(self.cache.get(params), None)
+        self.cache.put(params, {'rows': [['/', '10']]})
+        assert_equal(self.cache.get(params), {'rows': [['/', '10']]})
+
+    def test_profile_id(self):
+        assert_equal(self.cache.get_profile_id(), None)
+        self.cache.set_profile_id('12345')
+        assert_equal(self.cache.get_profile_id(), '12345')
+
+class RecordingGA(GA):
+    '''Answers batchGet requests with a report of one row per query.'''
+    def _request(self, method, url, description, extra_headers=None, cost=1,
+                 **kwargs):
+        self.requests.append(description)
+        return {'reports': [{'data': {'rows': [{'metrics': [{'values': ['live']}]}]}}
+                            for request in description['reportRequests']]}
+
+class TestBatchGetCache:
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ResponseCache(self.directory)
+        self.params = {'ids': 'ga:1', 'start-date': '2014-07-01',
+                       'end-date': '2014-07-31', 'metrics': 'ga:pageviews'}
+        self.cache.put(self.params, {'rows': [['cached']]})
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_live_requests_despite_cache(self):
+        client = RecordingGA(None, cache=self.cache)
+        client.requests = []
+        assert_equal(client.batch_get([self.params])[0]['rows'], [['live']])
+        assert_equal(len(client.requests), 1)
+        # and the cache is updated with the new response
+        assert_equal(self.cache.get(self.params)['rows'], [['live']])
+
+    def test_replay_reads_cache(self):
+        client = RecordingGA(None, cache=self.cache, replay=True)
+        client.requests = []
+        assert_equal(client.batch_get([self.params])[0]['rows'], [['cached']])
+        assert_equal(client.requests, [])
+
+    def test_replay_miss(self):
+        client = RecordingGA(None, cache=self.cache, replay=True)
+        client.requests = []
+        params = dict(self.params, metrics='ga:visits')
+        assert_raises(CacheMiss, client.get, params)
+        assert_raises(CacheMiss, client.batch_get, [self.params, params])
+        assert_equal(client.requests, [])
+
+class TestReportTranslation:
+
+    def test_to_report_request(self):
+        request = to_report_request({'ids': 'ga:1234',
+                                     'start-date': '2014-07-01',
+                                     'end-date': '2014-07-31',
+                                     'metrics': 'ga:pageviews, ga:visits',
+                                     'dimensions': 'ga:pagePath',
+                                     'sort': '-ga:pageviews',
+                                     'filters': 'ga:pagePath=~^/data/dataset/',
+                                     'start-index': 10001,
+                                     'max-results': 10000})
+        assert_equal(request['viewId'], '1234')
+        assert_equal(request['dateRanges'], [{'startDate': '2014-07-01',
+                                              'endDate': '2014-07-31'}])
+        assert_equal(request['metrics'], [{'expression': 'ga:pageviews'},
+                                          {'expression': 'ga:visits'}])
+        assert_equal(request['dimensions'], [{'name': 'ga:pagePath'}])
+        assert_equal(request['orderBys'], [{'fieldName': 'ga:pageviews',
+                                            'sortOrder': 'DESCENDING'}])
+        assert_equal(request['filtersExpression'], 'ga:pagePath=~^/data/dataset/')
+        assert_equal(request['pageToken'], '10000')
+
+    def test_from_report(self):
+        report = {'data': {'rows': [{'dimensions': ['/data/dataset/a'],
+                                     'metrics': [{'values': ['10', '4']}]}],
+                           'rowCount': 20},
+                  'nextPageToken': '1'}
+        assert_equal(from_report(report), {'rows': [['/data/dataset/a', '10', '4']],
+                                           'totalResults': 20,
+                                           'nextLink': '1'})
+
+    def test_from_empty_report(self):
+        assert_equal(from_report({'data': {}}), {'rows': [], 'totalResults': 0})
+
+class FakeClock(object):
+    '''A clock that only moves when something sleeps.'''
+    def __init__(self):
+        self.now = 1400000000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class TestQuotaScheduler:
+
+    def setup(self):
+        self.clock = FakeClock()
+
+    def _scheduler(self, **kwargs):
+        return QuotaScheduler(clock=self.clock.time, sleep=self.clock.sleep,
+                              **kwargs)
+
+    def test_burst_does_not_wait(self):
+        quota = self._scheduler(per_second=5)
+        for i in range(5):
+            quota.acquire()
+        assert_equal(self.clock.sleeps, [])
+
+    def test_waits_for_tokens(self):
+        quota = self._scheduler(per_second=2)
+        for i in range(4):
+            quota.acquire()
+        assert_equal(self.clock.sleeps, [0.5, 0.5])
+        assert_equal(quota.usage()['waited'], 1.0)
+
+    def test_cost(self):
+        quota = self._scheduler(per_second=2)
+        quota.acquire(cost=4)
+        assert_equal(self.clock.sleeps, [1.0])
+        assert_equal(quota.usage()['used'], 4)
+
+    def test_daily_limit(self):
+        quota = self._scheduler(per_second=100, per_day=3)
+        quota.acquire(cost=2)
+        assert_raises(QuotaExceeded, quota.acquire, 2)
+        quota.acquire()
+        assert_equal(quota.usage()['remaining_today'], 0)
+        # a new day
+        self.clock.now += 24 * 60 * 60
+        quota.acquire()
+        assert_equal(quota.usage()['used_today'], 1)
+        assert_equal(quota.usage()['used'], 4)
+
+    def test_day_is_pacific(self):
+        # 23:00 PDT on 30 June, then 01:00 PDT on 1 July
+        self.clock.now = calendar.timegm((2014, 7, 1, 6, 0, 0))
+        quota = self._scheduler(per_second=100, per_day=1)
+        quota.acquire()
+        self.clock.now += 2 * 60 * 60
+        quota.acquire()
+        assert_equal(quota.usage()['used_today'], 1)
+
+def test_pacific_date():
+    # PST in winter, PDT in summer
+    assert_equal(pacific_date(calendar.timegm((2014, 1, 15, 7, 59, 0))),
+                 datetime.date(2014, 1, 14))
+    assert_equal(pacific_date(calendar.timegm((2014, 1, 15, 8, 0, 0))),
+                 datetime.date(2014, 1, 15))
+    assert_equal(pacific_date(calendar.timegm((2014, 7, 15, 6, 59, 0))),
+                 datetime.date(2014, 7, 14))
+    assert_equal(pacific_date(calendar.timegm((2014, 7, 15, 7, 0, 0))),
+                 datetime.date(2014, 7, 15))
+    # the changes in 2014 were on 9 March and 2 November
+    assert_equal(pacific_date(calendar.timegm((2014, 3, 9, 9, 59, 0))),
+                 datetime.date(2014, 3, 9))
+    assert_equal(pacific_date(calendar.timegm((2014, 3, 10, 7, 0, 0))),
+                 datetime.date(2014, 3, 10))
+    assert_equal(pacific_date(calendar.timegm((2014, 11, 2, 7, 30, 0))),
+                 datetime.date(2014, 11, 2))
+    assert_equal(pacific_date(calendar.timegm((2014, 11, 3, 7, 30, 0))),
+                 datetime.date(2014, 11, 2))
@@ -1,6 +1,9 @@
-from nose.tools import assert_equal
+import datetime
+from nose.tools import assert_equal, assert_raises
 
-from ckanext.ga_report.download_analytics import DownloadAnalytics
+from ckanext.ga_report.download_analytics import (DownloadAnalytics, StatSpec,
+                                                   BREAKDOWNS, aggregate_breakdowns)
+from ckanext.ga_report.ga_client import GAError
 
 _filter_browser_version = DownloadAnalytics._filter_browser_version
 
@@ -27,3 +30,84 @@ class TestDownloadAnalytics:
         DownloadAnalytics._filter_out_long_tail(data, 10)
         assert_equal(data, {'Firefox': 100,
                             'Chrome': 150})
+
+class PagedDownloadAnalytics(DownloadAnalytics):
+    '''Serves the rows from a list, two at a time.'''
+    def __init__(self, rows, fail_at=None):
+        self.rows = rows
+        self.requests = []
+        self.fail_at = fail_at
+
+    def _get_json(self, args):
+        self.requests.append(args['start-index'])
+        if args['start-index'] == self.fail_at:
+            raise GAError('Request failed')
+        start = args['start-index'] - 1
+        results = {'rows': self.rows[start:start + 2]}
+        if start + 2 < len(self.rows):
+            results['nextLink'] = 'next'
+        return results
+
+class TestPaging:
+    def test_iter_rows(self):
+        rows = [['a', 1], ['b', 2], ['c', 3], ['d', 4], ['e', 5]]
+        downloader = PagedDownloadAnalytics(rows)
+        assert_equal(list(downloader._iter_rows({'start-index': 1})), rows)
+        assert_equal(downloader.requests, [1, 3, 5])
+
+    def test_iter_rows_first_page(self):
+        rows = [['a', 1], ['b', 2], ['c', 3]]
+        downloader = PagedDownloadAnalytics(rows)
+        first_page = {'rows': rows[:2], 'nextLink': 'next'}
+        assert_equal(list(downloader._iter_rows({'start-index': 1}, first_page)), rows)
+        assert_equal(downloader.requests, [3])
+
+    def test_iter_rows_empty(self):
+        downloader = PagedDownloadAnalytics([])
+        assert_equal(list(downloader._iter_rows({'start-index': 1})), [])
+
+    def test_iter_rows_failed_page(self):
+        rows = [['a', 1], ['b', 2], ['c', 3], ['d', 4], ['e', 5]]
+        downloader = PagedDownloadAnalytics(rows, fail_at=3)
+        pages = downloader._iter_rows({'start-index': 1})
+        assert_equal([pages.next(), pages.next()], rows[:2])
+        assert_raises(GAError, pages.next)
+
+class TestMonthPeriods:
+    def setup(self):
+        self.downloader = DownloadAnalytics.__new__(DownloadAnalytics)
+        self.downloader.period = 'monthly'
+
+    def test_past_months(self):
+        periods = self.downloader.month_periods(datetime.datetime(2012, 11, 1),
+                                                datetime.datetime(2013, 2, 1))
+        assert_equal([period[0] for period in periods],
+                     ['2012-11', '2012-12', '2013-01', '2013-02'])
+        assert_equal(periods[1], ('2012-12', 0, datetime.datetime(2012, 12, 1),
+                                  datetime.datetime(2012, 12, 31)))
+
+    def test_up_to_today(self):
+        now = datetime.datetime.now()
+        periods = self.downloader.month_periods(datetime.datetime(now.year, now.month, 1))
+        assert_equal(len(periods), 1)
+        assert_equal(periods[0][0], now.strftime('%Y-%m'))
+        assert_equal(periods[0][1], now.day)
+
+class TestBreakdowns:
+    def test_one_pass(self):
+        specs = [StatSpec('Browsers', lambda row: row[0]),
+                 StatSpec('Versions', lambda row: '%s %s' % (row[0], row[1])),
+                 StatSpec('Not IE', lambda row: row[0] if row[0] != 'IE' else None,
+                          threshold=10)]
+        rows = iter([['Firefox', '19', '20'], ['Firefox', '20', '5'],
+                     ['IE', '8', '7']])
+        assert_equal(aggregate_breakdowns(specs, rows),
+                     {'Browsers': {'Firefox': 25, 'IE': 7},
+                      'Versions': {'Firefox 19': 20, 'Firefox 20': 5, 'IE 8': 7},
+                      'Not IE': {'Firefox': 25}})
+
+    def test_browser_versions(self):
+        dimensions, specs = BREAKDOWNS['browser']
+        stats = aggregate_breakdowns(specs, [['Safari', '534.55.3', '3'],
+                                             ['Safari', '534.10', '4']])
+        assert_equal(stats['Browser versions'], {'Safari 53X': 7})
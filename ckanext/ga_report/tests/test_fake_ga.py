@@ -0,0 +1,148 @@
+import datetime
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.ga_report import ga_model
+from ckanext.ga_report.download_analytics import DownloadAnalytics
+from ckanext.ga_report.fake_ga import FakeGA, FakeGAServer, StaticToken, PROFILE_ID
+from ckanext.ga_report.ga_client import GA, GAError, to_report_request, from_report
+
+def _params(**params):
+    args = {'ids': 'ga:' + PROFILE_ID, 'start-date': '2014-01-01',
+            'end-date': '2014-01-31', 'metrics': 'ga:pageviews, ga:visits',
+            'dimensions': 'ga:pagePath', 'filters': 'ga:pagePath=~^/data/dataset/',
+            'start-index': 1, 'max-results': 10}
+    args.update(params)
+    return args
+
+class TestFakeGA:
+
+    def test_paging(self):
+        fake = FakeGA(datasets=25)
+        first = fake.query(_params())
+        assert_equal(first['totalResults'], 25)
+        assert_equal(len(first['rows']), 10)
+        assert 'nextLink' in first
+        last = fake.query(_params(**{'start-index': 21}))
+        assert_equal(len(last['rows']), 5)
+        assert 'nextLink' not in last
+
+    def test_repeatable(self):
+        assert_equal(FakeGA(seed=1).query(_params()), FakeGA(seed=1).query(_params()))
+        assert FakeGA(seed=1).query(_params()) != FakeGA(seed=2).query(_params())
+        assert FakeGA().query(_params()) != \
+            FakeGA().query(_params(**{'start-date': '2014-02-01'}))
+
+    def test_names(self):
+        fake = FakeGA(datasets=3, dataset_names=['water'])
+        assert_equal([row[0] for row in fake.query(_params())['rows']],
+                     ['/data/dataset/water', '/data/dataset/dataset-1',
+                      '/data/dataset/dataset-2'])
+
+    def test_batch_get_matches_query(self):
+        fake = FakeGA(datasets=25)
+        params = _params(**{'start-index': 11})
+        body = {'reportRequests': [to_report_request(params)]}
+        result = from_report(fake.batch_get(body)['reports'][0])
+        assert_equal(result['rows'], fake.query(params)['rows'])
+        assert_equal(result['nextLink'], '20')
+
+class FakeDownloadAnalytics(DownloadAnalytics):
+    def __init__(self, client):
+        super(FakeDownloadAnalytics, self).__init__(profile_id=PROFILE_ID)
+        self.client = client
+
+class TestFakeGAServer:
+
+    def setup(self):
+        self.fake = FakeGA(datasets=25, organizations=3)
+        self.server = FakeGAServer(self.fake).start()
+        self.client = GA(StaticToken(), api_url=self.server.api_url,
+                         batch_url=self.server.batch_url, retries=0)
+
+    def teardown(self):
+        self.server.stop()
+
+    def test_get(self):
+        assert_equal(self.client.get(_params()), self.fake.query(_params()))
+        assert_equal(self.server.requests, [('GET', '/analytics/v3/data/ga')])
+
+    def test_download(self):
+        downloader = FakeDownloadAnalytics(self.client)
+        data = downloader.download(datetime.datetime(2014, 1, 1),
+                                   datetime.datetime(2014, 1, 31),
+                                   '~^/data/dataset/[a-z0-9-_]+')
+        urls = [url for url, pageviews, visits in data['url']]
+        assert_equal(len(urls), 25)
+        assert_equal(len(set(urls)), 25)
+
+class FakeGALoad(object):
+    '''Loads into the database, from the fake GA.'''
+
+    def setup(self):
+        ga_model.init_tables()
+        self.fake = FakeGA(datasets=25, organizations=3, downloads=10)
+        self.server = FakeGAServer(self.fake).start()
+        self.downloader = DownloadAnalytics(profile_id=PROFILE_ID)
+        self.downloader.client = GA(StaticToken(), api_url=self.server.api_url,
+                                    batch_url=self.server.batch_url, retries=0)
+
+    def teardown(self):
+        self.server.stop()
+        ga_model.delete('All')
+
+class TestIncrementalLoad(FakeGALoad):
+
+    def _periods(self):
+        import ckan.model as model
+        return set(period_name for (period_name,) in
+                   model.Session.query(ga_model.GA_Stat.period_name).distinct())
+
+    def test_incremental_after_latest(self):
+        today = datetime.date.today()
+        yesterday = today - datetime.timedelta(days=1)
+        self.downloader.latest()
+        # today is only partly loaded, so no day is marked as loaded
+        assert_equal(ga_model.get_load_mark(), (today.strftime('%Y-%m'), None))
+
+        del self.server.requests[:]
+        self.downloader.latest_incremental()
+        assert self.server.requests, 'Nothing was loaded'
+        assert_equal(ga_model.get_load_mark(yesterday.strftime('%Y-%m')),
+                     (yesterday.strftime('%Y-%m'), yesterday))
+
+        # and the next run has nothing to do until tomorrow
+        del self.server.requests[:]
+        self.downloader.latest_incremental()
+        assert_equal(self.server.requests, [])
+
+    def test_old_mark_is_not_caught_up(self):
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        self.downloader.specific_month(datetime.datetime(2014, 1, 1))
+        assert_equal(ga_model.get_load_mark(),
+                     ('2014-01', datetime.date(2014, 1, 31)))
+
+        self.downloader.latest_incremental()
+        # just the month to date, not every month since
+        assert_equal(self._periods(), set(['2014-01', yesterday.strftime('%Y-%m')]))
+        assert_equal(ga_model.get_load_mark(),
+                     (yesterday.strftime('%Y-%m'), yesterday))
+
+class TestFailedLoad(FakeGALoad):
+
+    def _stats(self):
+        import ckan.model as model
+        return sorted((stat.stat_name, stat.key, stat.value) for stat in
+                      model.Session.query(ga_model.GA_Stat).
+                      filter_by(period_name='2014-01'))
+
+    def test_failed_query_is_not_published(self):
+        self.downloader.specific_month(datetime.datetime(2014, 1, 1))
+        stats = self._stats()
+        assert stats
+
+        self.fake.seed = 1
+        self.fake.failing.add('ga:browser,ga:browserVersion')
+        self.downloader.delete_first = True
+        assert_raises(GAError, self.downloader.specific_month,
+                      datetime.datetime(2014, 1, 1))
+        assert_equal(self._stats(), stats)
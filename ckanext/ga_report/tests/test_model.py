@@ -1,6 +1,11 @@
+import collections
 from nose.tools import assert_equal
 
-from ckanext.ga_report.ga_model import _normalize_url
+import ckan.model as model
+import ckan.plugins as p
+from ckanext.ga_report import ga_model
+from ckanext.ga_report.ga_model import (_normalize_url, ResourceAttributionIndex,
+                                        _publisher_descendants)
 
 class TestNormalizeUrl:
     def test_normal(self):
@@ -15,3 +20,228 @@ class TestNormalizeUrl:
         assert_equal(_normalize_url('https://data.gov.uk/dataset/weekly_fuel_prices'),
                      '/dataset/weekly_fuel_prices')
 
+
+class TestPublisherDescendants:
+    def _descendants(self, links, names):
+        children = collections.defaultdict(list)
+        for parent, child in links:
+            children[parent].append(child)
+        return _publisher_descendants(children, names)
+
+    def test_tree(self):
+        descendants = self._descendants([('a', 'b'), ('b', 'c'), ('a', 'd')],
+                                        ['a', 'b', 'c', 'd'])
+        assert_equal(descendants, {'a': set(['b', 'c', 'd']), 'b': set(['c']),
+                                   'c': set(), 'd': set()})
+
+    def test_loop(self):
+        # whichever publisher in the loop comes first, each one has all the
+        # others beneath it
+        links = [('a', 'b'), ('b', 'c'), ('c', 'a'), ('c', 'd')]
+        for names in (['a', 'b', 'c', 'd'], ['c', 'b', 'a', 'd'], ['b', 'd', 'a', 'c']):
+            descendants = self._descendants(links, names)
+            assert_equal(descendants['a'], set(['b', 'c', 'd']))
+            assert_equal(descendants['b'], set(['a', 'c', 'd']))
+            assert_equal(descendants['c'], set(['a', 'b', 'd']))
+            assert_equal(descendants['d'], set())
+
+    def test_self_link(self):
+        descendants = self._descendants([('a', 'a'), ('a', 'b')], ['a', 'b'])
+        assert_equal(descendants['a'], set(['b']))
+
+
+class TestResourceAttributionIndex:
+    def setup(self):
+        self.index = ResourceAttributionIndex.__new__(ResourceAttributionIndex)
+        self.index.by_id = {'abc-123': ('fuel-prices', 'energy')}
+        self.index.by_url = {'http://data.vic.gov.au/files/fuel.csv': ('fuel-prices', 'energy')}
+        self.index.by_path = {'/files/fuel.csv': ('fuel-prices', 'energy')}
+        self.index.by_files_path = {'/files/2014/rainfall.xls': ('rainfall', 'weather')}
+        self.index.by_filename = {'schools.csv': ('schools', None)}
+        self.index.urls = [('http://example.com/long/path/report.pdf', ('reports', 'finance'))]
+        self.index._matched = {}
+
+    def test_url(self):
+        assert_equal(self.index.resolve('HTTP://data.vic.gov.au/files/fuel.csv'),
+                     ('fuel-prices', 'energy'))
+
+    def test_url_path(self):
+        assert_equal(self.index.resolve('https://www.data.vic.gov.au/files/fuel.csv'),
+                     ('fuel-prices', 'energy'))
+
+    def test_part_of_url(self):
+        assert_equal(self.index.resolve('/path/report.pdf'), ('reports', 'finance'))
+        assert_equal(self.index.resolve('/path/other.pdf'), None)
+
+    def test_resource_id(self):
+        assert_equal(self.index.resolve('/dataset/x/resource/abc-123/download/fuel.csv'),
+                     ('fuel-prices', 'energy'))
+
+    def test_files_path(self):
+        assert_equal(self.index.resolve('/dataset/x/resource/gone/download/files/2014/rainfall.xls'),
+                     ('rainfall', 'weather'))
+
+    def test_filename(self):
+        assert_equal(self.index.resolve('/dataset/x/resource/gone/download/Schools.csv'),
+                     ('schools', None))
+
+class TestResourceMap:
+    '''Saves datasets, with the plugin loaded, and checks ga_resource_map.'''
+
+    @classmethod
+    def setup_class(cls):
+        ga_model.init_tables()
+        p.load('ga-report')
+
+    @classmethod
+    def teardown_class(cls):
+        p.unload('ga-report')
+        model.repo.rebuild_db()
+
+    def _context(self):
+        site_user = p.toolkit.get_action('get_site_user')({'model': model,
+                                                           'ignore_auth': True}, {})
+        return {'model': model, 'session': model.Session,
+                'user': site_user['name']}
+
+    def _create(self, name, url):
+        return p.toolkit.get_action('package_create')(
+            self._context(), {'name': name, 'resources': [{'url': url}]})
+
+    def _keys(self, resource_id):
+        return set((row.kind, row.key) for row in
+                   model.Session.query(ga_model.GA_ResourceMap).
+                   filter_by(resource_id=resource_id))
+
+    def _mapped_to(self, kind, key):
+        return model.Session.query(ga_model.GA_ResourceMap.resource_id).\
+            filter_by(kind=kind, key=key).scalar()
+
+    def test_saving_a_dataset(self):
+        dataset = self._create('ga-map-saved', 'http://example.com/files/rain.csv')
+        resource = dataset['resources'][0]
+        assert_equal(self._keys(resource['id']),
+                     set([('id', resource['id']),
+                          ('url', 'http://example.com/files/rain.csv'),
+                          ('path', '/files/rain.csv'),
+                          ('files', '/files/rain.csv'),
+                          ('filename', 'rain.csv')]))
+
+        # a new url is added and the old one stays mapped
+        resource['url'] = 'http://example.com/files/rainfall.csv'
+        p.toolkit.get_action('package_update')(self._context(), dataset)
+        keys = self._keys(resource['id'])
+        assert ('url', 'http://example.com/files/rainfall.csv') in keys
+        assert ('url', 'http://example.com/files/rain.csv') in keys
+
+    def test_seed_current_url_wins(self):
+        moved = self._create('ga-map-moved', 'http://example.com/files/wind.csv')
+        moved['resources'][0]['url'] = 'http://example.com/files/wind-2.csv'
+        p.toolkit.get_action('package_update')(self._context(), moved)
+        # another resource now has the url that the first one had
+        current = self._create('ga-map-current', 'http://example.com/files/wind.csv')
+
+        ga_model.seed_resource_map()
+        assert_equal(self._mapped_to('url', 'http://example.com/files/wind.csv'),
+                     current['resources'][0]['id'])
+        assert_equal(self._mapped_to('url', 'http://example.com/files/wind-2.csv'),
+                     moved['resources'][0]['id'])
+
+
+class TestUpdateUrlStats:
+    '''Stores urls straight into ga_url, without staging.'''
+
+    def setup(self):
+        ga_model.init_tables()
+
+    def teardown(self):
+        model.Session.rollback()
+        ga_model.delete('All')
+
+    def test_update(self):
+        url = '/data/dataset/ga-url-stats'
+        ga_model.update_url_stats('2014-05', 0, [(url, 3, 1), (url, 2, 1)])
+        ga_model.update_url_stats('2014-05', 0, [(url, 4, 2)])
+        assert_equal([(row.url, row.pageviews, row.visits) for row in
+                      model.Session.query(ga_model.GA_Url).
+                      filter_by(period_name='2014-05')],
+                     [(url, 9, 4)])
+        total = model.Session.query(ga_model.GA_UrlTotal).filter_by(url=url).one()
+        assert_equal((total.pageviews, total.visits), (9, 4))
+
+
+class TestMigrateUrlLayout:
+    '''Upgrades url tables in the layouts that earlier versions left.'''
+
+    def setup(self):
+        ga_model.init_tables()
+        connection = model.Session.connection()
+        connection.execute('drop table ga_url, ga_url_all')
+        connection.execute('''delete from ga_url_dim
+                               where url in ('/data/dataset/fuel',
+                                             '/data/dataset/rain')''')
+        # as the oldest versions created it, with the all-time figures in
+        # 'All' rows
+        connection.execute('''
+            create table ga_url (id text primary key, period_name text,
+                                 period_complete_day integer,
+                                 pageviews text, visits text, url text,
+                                 department_id text, package_id text)''')
+        connection.execute('''
+            insert into ga_url values
+                ('a', '2014-01', 0, '10', '5', '/data/dataset/fuel', 'org-a', 'fuel'),
+                ('b', '2014-02', 0, '7', '3', '/data/dataset/fuel', 'org-b', 'fuel'),
+                ('c', 'All', 0, '17', '8', '/data/dataset/fuel', 'org-a', 'fuel'),
+                ('d', 'All', 0, '4', '2', '/data/dataset/rain', 'org-a', 'rain')''')
+        model.Session.commit()
+
+    def teardown(self):
+        model.Session.rollback()
+        ga_model.delete('All')
+
+    def _upgrade(self):
+        ga_model.migrate_numeric_columns()
+        ga_model.migrate_url_layout()
+        ga_model.metadata.create_all(model.meta.engine)
+
+    def _urls(self, period_name):
+        return sorted((url.url, url.pageviews, url.visits) for url in
+                      model.Session.query(ga_model.GA_Url).
+                      filter_by(period_name=period_name))
+
+    def _totals(self):
+        return sorted((total.url, total.pageviews, total.visits) for total in
+                      model.Session.query(ga_model.GA_UrlTotal).
+                      filter(ga_model.GA_UrlTotal.url.in_(
+                          ['/data/dataset/fuel', '/data/dataset/rain'])))
+
+    def test_all_rows(self):
+        self._upgrade()
+        assert_equal(self._urls('2014-01'), [('/data/dataset/fuel', 10, 5)])
+        assert_equal(self._urls('2014-02'), [('/data/dataset/fuel', 7, 3)])
+        assert_equal(self._urls('All'), [])
+        assert_equal(self._totals(), [('/data/dataset/fuel', 17, 8),
+                                      ('/data/dataset/rain', 4, 2)])
+        dim = model.Session.query(ga_model.GA_UrlDim).\
+            filter_by(url='/data/dataset/fuel').one()
+        assert_equal(dim.department_id, 'org-b')
+
+        # and running it again does nothing
+        self._upgrade()
+        assert_equal(self._totals(), [('/data/dataset/fuel', 17, 8),
+                                      ('/data/dataset/rain', 4, 2)])
+
+    def test_url_totals_table(self):
+        # as versions before ga_url_dim created it
+        connection = model.Session.connection()
+        connection.execute('''
+            create table ga_url_all (url text primary key, pageviews integer,
+                                     visits integer, department_id text,
+                                     package_id text)''')
+        connection.execute('''
+            insert into ga_url_all values
+                ('/data/dataset/fuel', 20, 9, 'org-a', 'fuel')''')
+        model.Session.commit()
+        self._upgrade()
+        assert_equal(self._totals(), [('/data/dataset/fuel', 20, 9),
+                                      ('/data/dataset/rain', 4, 2)])
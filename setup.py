@@ -32,7 +32,9 @@ setup(
         [paste.paster_command]
         loadanalytics = ckanext.ga_report.command:LoadAnalytics
         initdb = ckanext.ga_report.command:InitDB
+        upgradedb = ckanext.ga_report.command:UpgradeDB
         getauthtoken = ckanext.ga_report.command:GetAuthToken
         fixtimeperiods = ckanext.ga_report.command:FixTimePeriods
+        benchmarkload = ckanext.ga_report.command:BenchmarkLoad
 	""",
 )